@@ -0,0 +1,82 @@
+import logging
+import time
+
+
+class Checkpointer:
+    """Coalesce the mysql replication log positions before writing them to mongo
+
+    The latest ``(log_file, log_pos)`` of each ``db.table`` is kept in memory and the changed
+    positions are flushed together, with one bulk upsert, at most every ``interval`` ms or
+    every ``max_events`` events. When the binlog is idle, :meth:`.tick` flushes the pending
+    positions once ``interval`` ms have passed. :meth:`.flush` must also be called on shutdown.
+
+    After a crash the events since the last flush, up to ``max_events`` events or ``interval``
+    ms of them, are read again from the binlog. The rows already applied are below the queue
+    offsets committed by the apply workers and are not queued again.
+
+    Args:
+        mongo (object): :class:`.MyMongoDB` instance
+        interval (int): longest time, in ms, a position is kept before being flushed
+        max_events (int): number of events after which the positions are flushed
+
+    Attributes:
+        positions (dict): latest position by ``db.table``
+
+    """
+    def __init__(self, mongo, interval=1000, max_events=1000):
+        self.mongo = mongo
+        self.logger = logging.getLogger(__name__)
+        self.interval = interval
+        self.max_events = max_events
+        self.positions = dict()
+        self.dirty = set()
+        self.events = 0
+        self.flushed = time.time()
+
+    def update(self, names, log_file, log_pos):
+        """Record the position reached by some tables, flushing when it is due
+
+        Args:
+            names (list): ``db.table`` names which have been replicated up to the position
+            log_file (str): mysql binlog file name
+            log_pos (int): position in the log file
+
+        Raises:
+            :class:`.SysException`
+
+        """
+        for name in names:
+            self.positions[name] = (log_file, log_pos)
+            self.dirty.add(name)
+        self.events += 1
+
+        if self.events >= self.max_events:
+            self.flush()
+        else:
+            self.tick()
+
+    def tick(self):
+        """Flush the pending positions if the oldest is kept for ``interval`` ms
+
+        Raises:
+            :class:`.SysException`
+
+        """
+        if (time.time() - self.flushed) * 1000 >= self.interval:
+            self.flush()
+
+    def flush(self):
+        """Write the changed positions to mongo
+
+        Raises:
+            :class:`.SysException`
+
+        """
+        if self.dirty:
+            positions = {name: self.positions[name] for name in self.dirty}
+            self.mongo.write_log_pos_many(positions)
+            self.logger.debug('Checkpoint ' + str(len(positions)) + ' tables after ' +
+                              str(self.events) + ' events')
+            self.dirty.clear()
+        self.events = 0
+        self.flushed = time.time()
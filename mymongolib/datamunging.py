@@ -1,144 +1,555 @@
 import logging
+import signal
+import sys
 import time
 import threading
 
+from collections import OrderedDict
+from queue import Empty
+from pymongo import InsertOne, ReplaceOne, DeleteOne, UpdateOne
+
 
 class DataMunging:
+    """Apply the events of the replicator queue to mongo
+
+    The queue is drained without pausing while it has a backlog: the batch size doubles
+    every time a full batch is read, up to ``max_batch_size``, and shrinks back when the
+    backlog is gone. Only a truly empty queue makes the loop wait: the ``{'seqnum': ...}``
+    notifications sent by the replicator wake it up at once, otherwise the wait times out
+    with an exponential backoff from ``min_backoff`` up to ``max_backoff`` seconds.
+
+    With ``idempotent`` set, the queue is consumed as an append-only log: inserts and updates
+    are applied as upserts on the primary key and deletes by key, so that replaying an event
+    is harmless. Replay safety needs a primary key: the rows of a table without one are
+    applied with plain operations matching all their columns (see :meth:`.make_operation`).
+    Instead of deleting every applied entry, the highest seqnum below which
+    everything has been applied is committed after each batch, the next run resumes from it,
+    and the queue is purged up to it every ``purge_interval`` seconds.
+    Capped and TTL queue layouts (see :class:`.MyMongoDB`) do not support deletes per entry
+    and are always consumed this way.
+    In both modes the offset is committed before the applied entries are deleted, and the
+    replicator does not queue again the rows below it when it replays the binlog after a
+    crash (see :meth:`.MyMongoDB.write_batch_to_queue`).
+
+    With ``tail`` set on a capped queue, records are not polled but streamed with a tailable
+    cursor (see :meth:`.MyMongoDB.tail_queue`) and applied as soon as they are written.
+
+    With a ``checkpointer`` the mongo queue is bypassed (direct pipeline): the replicator sends
+    the records through ``replicator_queue`` itself, they are applied idempotently, and only
+    then the binlog position they were read at is checkpointed. After a crash the replicator
+    reads again the events not checkpointed, and applies them again harmlessly.
+
+    Several instances can run in parallel processes, each one applying the tables of one
+    shard of the queue (see :meth:`.MyMongoDB.shard_key`): a table always belongs to the
+    same shard, so the events of a row are applied in order.
+
+    Args:
+        mongo (object): :class:`.MyMongoDB` instance
+        replicator_queue (object): multiprocessing queue written by the replicator for this shard
+        min_batch_size (int): batch size used when there is no backlog
+        max_batch_size (int): upper bound of the batch size
+        min_backoff (float): first wait, in seconds, on an empty queue
+        max_backoff (float): longest wait, in seconds, on an empty queue
+        shard (int): queue shard applied by this instance
+        shards (int): number of apply workers
+        idempotent (bool): apply with upserts and purge the queue by offset instead of deleting entries
+        tail (bool): stream the queue with a tailable cursor, needs the capped queue layout
+        checkpointer (object): :class:`.Checkpointer` of the binlog positions, enables the direct
+            pipeline
+
+    Attributes:
+        metrics (dict): current ``batch_size``, ``lag`` (seconds between the enqueue and
+            the apply of the last event) and ``backoff``
+
+    """
     mongo = None
+    metrics_interval = 10
+    purge_interval = 60
+    tail_await = 0.1
 
-    def __init__(self, mongo, replicator_queue):
+    def __init__(self, mongo, replicator_queue, min_batch_size=100, max_batch_size=5000,
+                 min_backoff=0.05, max_backoff=5, shard=0, shards=1, idempotent=False,
+                 tail=False, checkpointer=None):
         self.mongo = mongo
         self.logger = logging.getLogger(__name__)
         self.replicator_queue = replicator_queue
         self.lock = threading.Lock()
         self.last_seqnum = 0
-        self.run_parser = False
+        self.new_entries = threading.Event()    # 复制进程通知有新的数据写入队列
+        self.min_batch_size = min_batch_size
+        self.max_batch_size = max(min_batch_size, max_batch_size)
+        self.min_backoff = min_backoff
+        self.max_backoff = max(min_backoff, max_backoff)
+        self.metrics = {'batch_size': min_batch_size, 'lag': 0.0, 'backoff': 0.0}
+        self.metrics_written = 0
+        self.primary_keys = dict()  # (schema, table) --> 主键列
+        self.name = 'datamunging' if shards <= 1 else f'datamunging_{shard}'
+        self.mongo.set_queue_shard(shard, shards)
+        self.shard = shard
+        self.shards = shards
+        self.owned = dict()     # db.table --> 是否由本进程处理
+        self.checkpointer = checkpointer
+        self.direct = checkpointer is not None
+        if self.direct:
+            idempotent = True
+        elif not idempotent and mongo.queue_layout != 'work':
+            self.logger.info('Queue layout ' + mongo.queue_layout + ' is consumed with idempotent apply')
+            idempotent = True
+        self.idempotent = idempotent
+        if tail and mongo.queue_layout != 'capped':
+            self.logger.warning('Tailable cursors need the capped queue layout, poll queue ' + mongo.queue_layout)
+            tail = False
+        self.tail = tail
+        self.offset = -1
+        self.purged = time.time()
+        if not self.direct:
+            # 从已经提交的位置继续 之前的记录已经处理过
+            self.offset = self.mongo.read_queue_offset()
+            self.mongo.seek_queue(self.offset)
+            self.last_seqnum = max(self.offset, 0)
 
     def run(self, module_instance=None):
 
+        if self.direct:
+            self.run_direct(module_instance)
+            return
+
         queue_thread = threading.Thread(target=self.check_queue)
         queue_thread.daemon = True
         queue_thread.start()
 
+        if self.tail:
+            self.run_tail(module_instance)
+            return
+
+        batch_size = self.min_batch_size
+        backoff = self.min_backoff
+
         while True:
+            # 查询之前清除标记 查询之后到达的通知会立即唤醒等待
+            self.new_entries.clear()
             try:
-                # 一次性从队列中取出 100 条数据
-                queue = self.mongo.get_from_queue(100)
+                queue = self.mongo.get_from_queue(batch_size)
             except Exception as e:
                 self.logger.error('Cannot get entries from replicator queue. Error: ' + str(e))
+                time.sleep(backoff)
+                backoff = min(backoff * 2, self.max_backoff)
+                continue
 
-            if queue.count() < 1:   # 没有需要增量更新的数据
-                self.logger.debug('No entries in replicator queue')
-                time.sleep(1)
+            if len(queue) < 1:   # 没有需要增量更新的数据
+                self.logger.debug('No entries in replicator queue, wait ' + str(backoff) + 's')
+                self.update_metrics(batch_size, backoff=backoff)
+                if self.new_entries.wait(backoff):
+                    self.logger.debug('Woken up by replicator message')
+                    backoff = self.min_backoff
+                    continue
+                backoff = min(backoff * 2, self.max_backoff)
                 continue
 
-                # if not self.run_parser:
-                #    self.logger.debug('No messages from replicator queue')
-                #    continue
+            self.apply_batch(queue, module_instance)
+            self.update_metrics(batch_size, last=queue[-1])
 
-            to_delete = list()  # 处理的任务序列号加入该数组 后续删除
-            # db.comcn_actualcontroller.find({"id": {"$type": 16}}).limit(10)
-            # 在使用 csv 处理的过程中 除了数字 其他都变成了字符串 float 也变成了 float
+            if self.mongo.queue_hwm < queue[-1]['seqnum']:
+                # 有记录没有成功 从失败的位置重试 等待之后再读
+                time.sleep(backoff)
+                backoff = min(backoff * 2, self.max_backoff)
+                continue
+            backoff = self.min_backoff
 
-            for record in queue:
-                if module_instance is not None:
-                    try:
-                        # TODO(furuiyang) 对数据的处理 这里可以写成 csv 文件的处理方式
-                        doc = module_instance.run(record, self.mongo)
-                    except Exception as e:
-                        self.logger.error('Error during parse data with module. Error: ' + str(e))
-                        doc = record
-
-                key = None
-                self.logger.debug('Event: ' + doc['event_type'])
-
-                # 废弃这一步
-                # ---------------------对更新和删除事件获取主键----------------------------------------
-                # if doc['event_type'] in ['update', 'delete']:
-                #     self.logger.debug('Event: ' + doc['event_type'])
-                #     try:
-                #         key = self.mongo.get_primary_key(doc['table'], doc['schema'])
-                #         self.logger.debug(key)
-                #     except Exception as e:
-                #         self.logger.error('Cannot get primary key for table ' + doc['table'] +
-                #                           ' in schema ' + doc['schema'] + '. Error: ' + str(e))
-
-                # -------------------------插入事件--------------------------------------------------
-                if doc['event_type'] == 'insert':
-                    try:
-                        # TODO 对 doc['value'] 进行处理
-                        self.mongo.insert(doc['values'], doc['schema'], doc['table'])
-                        to_delete.append(str(doc['_id']))
-                        # 刷新记录点
-                        self.last_seqnum = doc['seqnum']
-                    except Exception as e:
-                        self.logger.error('Cannot insert document into collection ' + doc['table'] +
-                                          ' db ' + doc['schema'] + ' Error: ' + str(e))
-
-                # 废弃获取 key 直接置为 None
-                elif doc['event_type'] == 'update':
-                    if key is None:
-                        # 以之前的整个 doc 作为 primary
-                        primary_key = doc['values']['before']
-                    else:
-                        primary_key = dict()
-                        for k in key['primary_key']:
-                            primary_key[k] = doc['values']['after'][k]
-                    try:
-                        self.mongo.update(doc['values']['after'], doc['schema'], doc['table'], primary_key)
-                        to_delete.append(doc['_id'])
-                        self.last_seqnum = doc['seqnum']
-                    except Exception as e:
-                        self.logger.error('Cannot update document ' + str(doc['_id']) +
-                                          ' into collection ' + doc['table'] +
-                                          ' db ' + doc['schema'] + ' Error: ' + str(e))
-                elif doc['event_type'] == 'delete':
-                    if key is not None:
-                        primary_key = dict()
-                        for k in key['primary_key']:
-                            primary_key[k] = doc['values'][k]
-                    else:
-                        primary_key = None
+            # 读满一批说明仍有积压 扩大批量; 否则逐步回落
+            if len(queue) >= batch_size:
+                batch_size = min(batch_size * 2, self.max_batch_size)
+            else:
+                batch_size = max(batch_size // 2, self.min_batch_size)
+
+    def run_direct(self, module_instance=None):
+        """Apply the records sent by the replicator, then checkpoint their binlog position
+
+        Messages waiting in the replicator queue are merged into batches of up to
+        ``max_batch_size`` records. A batch is applied again until every record is written,
+        so a binlog position is only checkpointed once all the events before it are applied.
+        The replicator also sends position only messages to every worker periodically, so
+        the tables of a worker without events still advance their position.
+
+        Args:
+            module_instance (object): parser module run on each record before applying it
+
+        """
+        def shutdown(signum, frame):
+            self.logger.info('Datamunging got signal ' + str(signum) + ', checkpoint and exit')
+            sys.exit(0)
+
+        signal.signal(signal.SIGTERM, shutdown)
+
+        try:
+            while True:
+                try:
+                    records, position = self.read_direct(self.max_batch_size)
+                except Exception as e:
+                    self.logger.error('Cannot read replicator messages. Error: ' + str(e))
+                    time.sleep(self.min_backoff)
+                    continue
 
+                if position is None:
+                    self.update_metrics(self.max_batch_size, backoff=self.max_backoff)
+                    # 空闲时写入还没有写入的位置
                     try:
-                        self.mongo.delete(doc=doc['values'], schema=doc['schema'], collection=doc['table'],
-                                          primary_key=primary_key)
-                        to_delete.append(doc['_id'])
-                        self.last_seqnum = doc['seqnum']
+                        self.checkpointer.flush()
                     except Exception as e:
-                        self.logger.error('Cannot delete document ' + str(doc['_id']) +
-                                            ' into collection ' + doc['table'] +
-                                            ' db ' + doc['schema'] + ' Error: ' + str(e))
+                        self.logger.error('Cannot checkpoint log position. Error: ' + str(e))
+                    continue
 
-            # 删除已经处理过的任务序列号
-            self.logger.debug('Delete records: ' + str(to_delete))
-            for queue_id in to_delete:
-
-                import bson
-                queue_id = bson.ObjectId(queue_id)
+                # 只有位置的消息 (heartbeat) 没有记录 直接记录位置
+                backoff = self.min_backoff
+                pending = records
+                while pending:
+                    self.apply_batch(pending, module_instance)
+                    pending = [record for record in pending if record['seqnum'] > self.offset]
+                    if pending:
+                        # 位置不能越过没有写入的记录 等待之后重试
+                        time.sleep(backoff)
+                        backoff = min(backoff * 2, self.max_backoff)
+                if records:
+                    self.update_metrics(len(records), last=records[-1])
 
+                names = [name for name in position['live'] if self.owns(name)]
                 try:
-                    self.mongo.delete_from_queue({'_id': queue_id})
+                    self.checkpointer.update(names, position['log_file'], position['log_pos'])
                 except Exception as e:
-                    self.logger.error('Cannot delete document from queue Error: ' + str(e))
+                    self.logger.error('Cannot checkpoint log position. Error: ' + str(e))
+        finally:
+            try:
+                self.checkpointer.flush()
+            except Exception as e:
+                self.logger.error('Cannot write the last log positions. Error: ' + str(e))
 
-            time.sleep(5)
+    def read_direct(self, batch_size):
+        """Read a batch of records sent by the replicator
 
-    def check_queue(self):
-        self.logger.info('Start QueueMonitor')
+        Waits up to ``max_backoff`` seconds for a first message, then takes the messages
+        already waiting without blocking.
+
+        Args:
+            batch_size (int): number of records after which no more message is taken
+
+        Returns:
+            tuple: (records, last message), the message is None when nothing came during the
+                wait; the records are also empty for position only messages
+
+        """
+        try:
+            msg = self.replicator_queue.get(timeout=self.max_backoff)
+        except Empty:
+            return list(), None
+
+        records = list(msg['records'])
+        while len(records) < batch_size:
+            try:
+                msg = self.replicator_queue.get_nowait()
+            except Empty:
+                break
+            records.extend(msg['records'])
+
+        return records, msg
+
+    def owns(self, name):
+        """Whether a table is applied by this worker
+
+        Args:
+            name (str): ``db.table`` name
+
+        Returns:
+            bool: True if the table belongs to the shard of this worker
+
+        """
+        if name not in self.owned:
+            schema, table = name.split('.', 1)
+            self.owned[name] = self.mongo.shard_key(schema, table) % self.shards == self.shard
+        return self.owned[name]
 
+    def run_tail(self, module_instance=None):
+        """Apply the records of the queue as they are streamed by a tailable cursor
+
+        Args:
+            module_instance (object): parser module run on each record before applying it
+
+        """
+        backoff = self.min_backoff
         while True:
-            if not self.replicator_queue.empty():
+            try:
+                for queue in self.mongo.tail_queue(self.max_batch_size, self.tail_await):
+                    if len(queue) < 1:
+                        self.update_metrics(self.max_batch_size, backoff=self.tail_await)
+                        continue
+
+                    self.apply_batch(queue, module_instance)
+                    self.update_metrics(len(queue), last=queue[-1])
+
+                    if self.offset < queue[-1]['seqnum']:
+                        # 有记录没有成功 游标从失败的位置重新打开
+                        time.sleep(backoff)
+                        backoff = min(backoff * 2, self.max_backoff)
+                        continue
+                    backoff = self.min_backoff
+            except Exception as e:
+                self.logger.error('Cannot tail replicator queue. Error: ' + str(e))
+                time.sleep(backoff)
+                backoff = min(backoff * 2, self.max_backoff)
+
+    def update_metrics(self, batch_size, last=None, backoff=0.0):
+        """Refresh the drain metrics and periodically publish them to mongo
+
+        Args:
+            batch_size (int): batch size of the drain loop
+            last (dict): last queue record read, used to compute the replication lag
+            backoff (float): current wait on an empty queue, in seconds
+
+        """
+        self.metrics['batch_size'] = batch_size
+        self.metrics['backoff'] = backoff
+        if last is not None:
+            # ObjectId 中包含了写入队列的时间
+            enqueued = last['_id'].generation_time.timestamp()
+            self.metrics['lag'] = max(time.time() - enqueued, 0.0)
+        elif backoff:
+            self.metrics['lag'] = 0.0
+
+        if time.time() - self.metrics_written >= self.metrics_interval:
+            self.metrics_written = time.time()
+            self.logger.debug('Drain metrics: ' + str(self.metrics))
+            try:
+                self.mongo.write_metrics(self.name, self.metrics)
+            except Exception as e:
+                self.logger.error('Cannot write ' + self.name + ' metrics. Error: ' + str(e))
+
+    def apply_batch(self, records, module_instance=None):
+        """Apply a batch of queue records with one bulk write per target collection
+
+        Records are grouped by ``schema.table`` keeping their queue order, so that each
+        target collection receives a single ordered ``bulk_write``. The queue offset is
+        then committed (see :meth:`.commit_offset`) and, unless in idempotent mode, the queue
+        entries whose operations have been applied are removed with one ``delete_many``.
+        When a write fails, the queue is read again from the first record not applied.
+
+        Args:
+            records (list): queue documents sorted by seqnum
+            module_instance (object): parser module run on each record before applying it
+
+        Returns:
+            int: number of events applied
+
+        """
+        start = time.time()
+        groups = OrderedDict()   # (schema, table) --> (operations, queue documents)
+
+        for record in records:
+            doc = record
+            if module_instance is not None:
                 try:
-                    self.logger.debug('Try to read from replicator queue')
-                    msg_queue = self.replicator_queue.get()
-                    self.logger.debug('Read from replicator queue')
-                    self.manage_replicator_msg(msg_queue)
-                    self.logger.debug('Replicator message managed')
+                    # TODO(furuiyang) 对数据的处理 这里可以写成 csv 文件的处理方式
+                    doc = module_instance.run(record, self.mongo)
                 except Exception as e:
-                    self.logger.error('Cannot read and manage replicator message. Error: ' + str(e))
+                    self.logger.error('Error during parse data with module. Error: ' + str(e))
+                    doc = record
+
+            self.logger.debug('Event: ' + doc['event_type'])
+            try:
+                operation = self.make_operation(doc, self.get_primary_key(doc['schema'], doc['table']),
+                                                upsert=self.idempotent)
+            except Exception as e:
+                self.logger.error('Cannot build operation for queue entry ' + str(doc['_id']) + ' Error: ' + str(e))
+                continue
+
+            if operation is None:
+                self.logger.error('Unknown event type ' + str(doc['event_type']) +
+                                  ' for queue entry ' + str(doc['_id']))
+                continue
+
+            operations, docs = groups.setdefault((doc['schema'], doc['table']), (list(), list()))
+            operations.append(operation)
+            docs.append(doc)
+
+        applied = list()    # 处理成功的任务 后续从队列中删除
+        failed = None       # 没有处理成功的最小序列号
+        for (schema, table), (operations, docs) in groups.items():
+            try:
+                done = self.mongo.bulk_write(operations, schema, table)
+            except Exception as e:
+                self.logger.error('Cannot apply ' + str(len(operations)) + ' events into collection ' + table +
+                                  ' db ' + schema + ' Error: ' + str(e))
+                done = 0
+            applied.extend(docs[:done])
+            if done < len(docs):
+                failed = docs[done]['seqnum'] if failed is None else min(failed, docs[done]['seqnum'])
+
+        if applied:
+            # 刷新记录点
+            self.last_seqnum = max(self.last_seqnum, max(doc['seqnum'] for doc in applied))
+
+        if self.direct:
+            # 没有队列可以回退 由调用方重试失败之后的记录
+            self.offset = records[-1]['seqnum'] if failed is None else failed - 1
+        else:
+            # 从失败的位置重新读取 已经删除的记录不会再读到
+            self.commit_offset(records[-1]['seqnum'] if failed is None else failed - 1)
+            if applied and not self.idempotent:
+                # 删除已经处理过的任务 删除之前崩溃时 这些记录在提交的位置之前 不会再读到
+                try:
+                    self.mongo.delete_many_from_queue([doc['_id'] for doc in applied])
+                except Exception as e:
+                    self.logger.error('Cannot delete documents from queue Error: ' + str(e))
+
+        elapsed = time.time() - start
+        self.logger.info(f'Applied {len(applied)}/{len(records)} events on {len(groups)} collections '
+                         f'in {elapsed:.3f}s ({len(applied) / max(elapsed, 1e-6):.1f} events/s)')
+
+        return len(applied)
+
+    def commit_offset(self, offset):
+        """Commit the queue offset and periodically purge the queue
+
+        Every record up to ``offset`` has been applied. When a batch is only partly applied
+        the offset is below the end of the batch: the queue is read again from there, the
+        records already applied after it are replayed harmlessly in idempotent mode, or have
+        been deleted from the queue otherwise.
+
+        Args:
+            offset (int): highest seqnum below which every record has been applied
+
+        """
+        self.mongo.seek_queue(offset)
+        if offset <= self.offset:
+            return
+
+        try:
+            self.mongo.write_queue_offset(offset)
+        except Exception as e:
+            self.logger.error('Cannot commit queue offset ' + str(offset) + '. Error: ' + str(e))
+            return
+        self.offset = offset
+
+        if time.time() - self.purged >= self.purge_interval:
+            self.purged = time.time()
+            try:
+                deleted = self.mongo.purge_queue(self.offset)
+                self.logger.debug('Purged ' + str(deleted) + ' entries from queue up to ' + str(self.offset))
+            except Exception as e:
+                self.logger.error('Cannot purge queue up to ' + str(self.offset) + '. Error: ' + str(e))
+
+    def get_primary_key(self, schema, table):
+        """Get the primary key columns of a table, cached for the life of the process
 
-            time.sleep(.1)
+        The first lookup of a table also ensures an index on its primary key columns in the
+        target collection, so that updates and deletes are index lookups.
+
+        Args:
+            schema (str): mongo database name
+            table (str): mongo collection name
+
+        Returns:
+            list: primary key columns, None when the table has no known primary key
+
+        """
+        if (schema, table) in self.primary_keys:
+            return self.primary_keys[(schema, table)]
+
+        key = None
+        try:
+            doc = self.mongo.get_primary_key(table, schema)
+            if doc is not None and doc.get('primary_key'):
+                key = list(doc['primary_key'])
+        except Exception as e:
+            self.logger.error('Cannot get primary key for table ' + table +
+                              ' in schema ' + schema + '. Error: ' + str(e))
+            return None
+
+        if key is None:
+            self.logger.warning('No primary key for table ' + table + ' in schema ' + schema +
+                                ', updates and deletes match on all the columns and replayed '
+                                'events are not applied idempotently')
+        else:
+            try:
+                self.mongo.ensure_index(key, schema, table)
+            except Exception as e:
+                self.logger.error('Cannot create primary key index on ' + schema + '.' + table +
+                                  '. Error: ' + str(e))
+
+        self.primary_keys[(schema, table)] = key
+        return key
+
+    def make_operation(self, doc, key=None, upsert=False):
+        """Translate a queue record into the pymongo write operation to apply
+
+        With ``upsert`` the operation can be applied again without effect: inserts replace
+        the row matched by key, updates ``$set`` the new values on the row matched by key,
+        creating it when missing, and deletes remove by key. Replay safety needs the primary
+        key: a row without known key is matched on all its columns, so plain operations are
+        built for it whatever ``upsert``, as an upsert on the whole row would leave the old
+        version of an updated row or duplicate an inserted one.
+
+        Args:
+            doc (dict): queue record as written by :meth:`.MyMongoDB.write_to_queue`
+            key (list): primary key columns of the table, the whole row is matched if None
+            upsert (bool): build idempotent operations when the row has a key
+
+        Returns:
+            object: pymongo write operation, None for unknown event types
+
+        """
+        if doc['event_type'] == 'insert':
+            if upsert and self.has_key(doc['values'], key):
+                return ReplaceOne(self.key_filter(doc['values'], key), doc['values'], upsert=True)
+            return InsertOne(doc['values'])
+        elif doc['event_type'] == 'update':
+            before = doc['values']['before']
+            if upsert and self.has_key(before, key):
+                return UpdateOne(self.key_filter(before, key), {'$set': doc['values']['after']}, upsert=True)
+            return ReplaceOne(self.key_filter(before, key), doc['values']['after'])
+        elif doc['event_type'] == 'delete':
+            return DeleteOne(self.key_filter(doc['values'], key))
+        return None
+
+    @staticmethod
+    def has_key(values, key):
+        """Tell whether a row can be matched on its primary key
+
+        Args:
+            values (dict): row values
+            key (list): primary key columns
+
+        Returns:
+            bool: True if the key is known and every key column is in the row
+
+        """
+        return key is not None and all(k in values for k in key)
+
+    @staticmethod
+    def key_filter(values, key):
+        """Filter matching a row on its primary key, or on all its columns without key
+
+        Args:
+            values (dict): row values
+            key (list): primary key columns
+
+        Returns:
+            dict: mongo filter
+
+        """
+        if not DataMunging.has_key(values, key):
+            return values
+        return {k: values[k] for k in key}
+
+    def check_queue(self):
+        self.logger.info('Start QueueMonitor')
+
+        while True:
+            try:
+                # 阻塞读取 消息到达时立即处理 不再轮询
+                msg_queue = self.replicator_queue.get()
+                self.manage_replicator_msg(msg_queue)
+            except Exception as e:
+                self.logger.error('Cannot read and manage replicator message. Error: ' + str(e))
+                time.sleep(.1)
 
     def manage_replicator_msg(self, msg):
         with self.lock:
@@ -147,7 +558,6 @@ class DataMunging:
             self.logger.debug('Last seqnum: ' + str(self.last_seqnum))
             if msg['seqnum'] > self.last_seqnum:
                 self.logger.debug('new entries in queue')
-                self.run_parser = True
+                self.new_entries.set()
             else:
                 self.logger.debug('NO new entries in queue')
-                self.run_parser = False
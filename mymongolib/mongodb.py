@@ -1,9 +1,12 @@
 import pymongo
 import urllib.parse
 import logging
+import time
+import zlib
 
 from .exceptions import SysException
-from pymongo.errors import CollectionInvalid
+from pymongo import UpdateOne, CursorType
+from pymongo.errors import BulkWriteError
 from datetime import datetime
 
 # logger = logging.getLogger(__name__)
@@ -17,8 +20,16 @@ class MyMongoDB:
 
     Attributes:
         mdb (object): pymongo client instance
+        conf (dict): connection parameters, to open a new instance in another process
         utildb (str): utility database used for synchro
-        checked_colls (list): collections already created
+        colls (dict): collection handles by (db_name, coll_name)
+        queue_hwm (int): highest seqnum read from the replicator queue
+        queue_shards (int): number of apply workers the replicator queue is split between
+        queue_shard (int): queue shard read by this instance, None reads all
+        queue_applied (dict): committed offset by queue shard, rows up to it are not queued again
+        queue_layout (str): layout of the replicator queue: ``work`` (entries deleted once applied),
+            ``capped`` (capped collection of ``queue_size`` bytes) or ``ttl`` (entries expire
+            ``queue_ttl`` seconds after their insert)
 
     Raises:
         :class:`.SysException`
@@ -26,7 +37,10 @@ class MyMongoDB:
     """
     mdb = None
     utildb = ''
-    checked_colls = []
+    queue_fields = {'schema': True, 'table': True, 'event_type': True, 'seqnum': True, 'values': True}
+    queue_shards = 1
+    queue_shard = None
+    queue_applied = dict()
 
     def __init__(self, conf):
         self.logger = logging.getLogger(__name__)
@@ -50,6 +64,14 @@ class MyMongoDB:
         except Exception as e:
             raise SysException(e)
         self.utildb = conf['utildb']
+        self.conf = dict(conf)  # 在其他进程中重新连接
+        self.colls = dict()
+        self.queue_hwm = -1     # 已经从队列中读取的最大序列号
+        self.queue_layout = conf.get('queue_layout', 'work')
+        self.queue_size = int(conf.get('queue_size', 1024 ** 3))
+        self.queue_ttl = int(conf.get('queue_ttl', 86400))
+        if self.queue_layout not in ('work', 'capped', 'ttl'):
+            raise SysException('Unknown queue layout ' + self.queue_layout)
 
     def get_db(self, db_name):
         """Check if database exists, otherwise creates it
@@ -75,7 +97,11 @@ class MyMongoDB:
         return db
 
     def get_coll(self, coll_name, db_name):
-        """Check if collection exists, otherwise creates it
+        """Get a collection handle
+
+        Handles are cached per instance by ``(db_name, coll_name)`` so the hot paths do no
+        extra round trip: mongo creates a collection on its first write, and the utility
+        collections are set up once at startup by :meth:`.bootstrap`.
 
         Args:
             coll_name (str): mongo collection name
@@ -88,42 +114,84 @@ class MyMongoDB:
             :class:`.SysException`
 
         """
-        new = False
-        db = None
+        key = (db_name, coll_name)
+        coll = self.colls.get(key)
+        if coll is None:
+            try:
+                coll = self.get_db(db_name)[coll_name]
+            except Exception as e:
+                raise SysException(e)
+            self.colls[key] = coll
+
+        return coll
+
+    def bootstrap(self):
+        """Set up the utility collections, to be run once at startup
+
+        Seeds the counters and the mysqllog documents when missing and creates the indexes
+        used by the replication. The replicator queue is created as a capped collection with
+        the ``capped`` layout, and gets a TTL index on the insert time with the ``ttl`` one.
 
+        Raises:
+            :class:`.SysException`
+
+        """
+        counters = self.get_coll('counters', self.utildb)
+        mysqllog = self.get_coll('mysqllog', self.utildb)
+        queue = self.get_coll('replicator_queue', self.utildb)
         try:
-            db = self.get_db(db_name)
+            if self.queue_layout == 'capped':
+                db = self.get_db(self.utildb)
+                if 'replicator_queue' not in db.collection_names():
+                    db.create_collection('replicator_queue', capped=True, size=self.queue_size)
+                elif not queue.options().get('capped'):
+                    self.logger.warning('replicator_queue exists and is not capped, drop it to use the capped layout')
+            elif self.queue_layout == 'ttl':
+                # 过期的记录由 mongo 在后台删除
+                queue.create_index('ts', expireAfterSeconds=self.queue_ttl)
+
+            for seq_name in ['insert_seq', 'update_seq', 'delete_seq']:
+                counters.update_one({'_id': seq_name}, {'$setOnInsert': {'num': 0}}, upsert=True)
+            mysqllog.update_one({'_id': 'last_log_pos'},
+                                {'$setOnInsert': {'log_file': 'NA', 'log_pos': 'NA'}}, upsert=True)
+            mysqllog.create_index('name')
+            # 序列号唯一 重放 binlog 时重复的行不会再次写入; 同时用于有序读取队列
+            queue.create_index('seqnum', unique=True)
+            # 并行的 datamunging 进程按照分片读取队列 分片号相等 序列号范围
+            queue.create_index([('shard', pymongo.ASCENDING), ('seqnum', pymongo.ASCENDING)])
         except Exception as e:
-            SysException(e)
+            raise SysException(e)
 
-        if coll_name not in self.checked_colls:
-            try:
-                db.create_collection(coll_name)
-                new = True
-            except CollectionInvalid as e:
-                self.logger.info(str(e))
-            except Exception as e:
-                raise SysException(e)
+        self.reshard_queue()
+        self.reshard_queue_offsets()
 
-            self.checked_colls.append(coll_name)
+    def reshard_queue(self):
+        """Move the queue records written for another number of apply workers to their shard
 
-        coll = db[coll_name]
+        Records store their shard for the number of apply workers they were written with;
+        when that number has changed, the records left in the queue are assigned to the
+        shards of the current number, one table at a time.
 
-        if new:
-            if coll_name == 'counters':
-                try:
-                    coll.insert_one({'_id': 'insert_seq', 'num': 0})
-                    coll.insert_one({'_id': 'update_seq', 'num': 0})
-                    coll.insert_one({'_id': 'delete_seq', 'num': 0})
-                except Exception as e:
-                    raise SysException(e)
-            elif coll_name == 'mysqllog':
-                try:
-                    coll.insert_one({'_id': 'last_log_pos', 'log_file': 'NA', 'log_pos': 'NA'})
-                except Exception as e:
-                    raise SysException(e)
+        Raises:
+            :class:`.SysException`
 
-        return coll
+        """
+        coll = self.get_coll('replicator_queue', self.utildb)
+        stale = {'shards': {'$ne': self.queue_shards}}
+        try:
+            tables = list(coll.aggregate([{'$match': stale},
+                                          {'$group': {'_id': {'schema': '$schema', 'table': '$table'}}}]))
+            for doc in tables:
+                schema, table = doc['_id']['schema'], doc['_id']['table']
+                query = dict(stale, schema=schema, table=table)
+                coll.update_many(query, {'$set': {'shard': self.shard_key(schema, table) % self.queue_shards,
+                                                  'shards': self.queue_shards}})
+        except Exception as e:
+            raise SysException(e)
+
+        if tables:
+            self.logger.info('Moved queue records of ' + str(len(tables)) + ' tables to ' +
+                             str(self.queue_shards) + ' shards')
 
     '''
     def get_next_seqnum(self, seq_name):
@@ -146,24 +214,37 @@ class MyMongoDB:
         Args:
             log_file (str): mysql binlog file name
             log_pos (int): position in the log file
+            db (str): mysql database name
+            table (str): mysql table name
+
+        Raises:
+            :class:`.SysException`
+
+        """
+        self.write_log_pos_many({f"{db}.{table}": (log_file, log_pos)})
+
+    def write_log_pos_many(self, positions):
+        """Write the mysql replication log positions of several tables with one bulk upsert
+
+        Args:
+            positions (dict): ``(log_file, log_pos)`` by ``db.table`` name
 
         Raises:
             :class:`.SysException`
 
+        See Also:
+            :class:`.checkpoint.Checkpointer`
+
         """
-        # 重写刷新日志文件的位置
         coll = self.get_coll("mysqllog", self.utildb)
-        name = f"{db}.{table}"
+        requests = [UpdateOne({"name": name}, {"$set": {"log_file": log_file, "log_pos": log_pos}}, upsert=True)
+                    for name, (log_file, log_pos) in positions.items()]
+        if not requests:
+            return
         try:
-            coll.replace_one({"name": name}, {'log_file': log_file, 'log_pos': log_pos})
+            coll.bulk_write(requests, ordered=False)
         except Exception as e:
-            raise SystemError(e)
-
-        # coll = self.get_coll('mysqllog', self.utildb)
-        # try:
-        #     coll.replace_one({'_id': 'last_log_pos'}, {'log_file': log_file, 'log_pos': log_pos})
-        # except Exception as e:
-        #     raise SysException(e)
+            raise SysException(e)
 
     def get_log_pos(self, db, table):
         """Read the last position of mysql replication log from mongodb
@@ -203,7 +284,7 @@ class MyMongoDB:
         #
         # return last_log
 
-    def write_to_queue(self, event_type, values, schema, table):
+    def write_to_queue(self, event_type, values, schema, table, seqnum):
         """Write the new mysql record to a mongo queue
 
         This function write the mysql records in mysql replication logs to a queue in mongo to be processed later
@@ -213,36 +294,83 @@ class MyMongoDB:
             values: values to be handled
             schema (str): mongo database name
             table (str): mongo collection name
+            seqnum (int): sequence number of the record, see :func:`.mysql.binlog_seqnum`
+
+        Returns:
+            int: mongo sequence number
+
+        Raises:
+            :class:`.SysException`
+
+        See Also:
+            :meth:`.write_batch_to_queue`
+
+        """
+        return self.write_batch_to_queue(event_type, [values], schema, table, seqnum)
+
+    def write_batch_to_queue(self, event_type, rows, schema, table, seqnum):
+        """Write all the rows of a mysql binlog event to the mongo queue with one insert
+
+        Rows get consecutive sequence numbers starting from ``seqnum``. Sequence numbers are
+        unique in the queue, so rows already queued before a replay of the binlog are skipped.
+        Rows up to the offset committed for their shard, loaded with :meth:`.load_queue_offsets`,
+        have already been applied and deleted from the queue: they are not queued again.
+
+        Args:
+            event_type (str): type of sql statement (insert, update, delete)
+            rows (list): values of each row of the event
+            schema (str): mongo database name
+            table (str): mongo collection name
+            seqnum (int): sequence number of the first row
 
         Returns:
-            datetime: mongo sequence number (id)
+            int: mongo sequence number of the last row
 
         Raises:
             :class:`.SysException`
 
         """
-        seqnum = datetime.now().timestamp()
-        # 为了在之后将不同的事件类型放在不同的集合里面
-        if event_type == 'insert':
-            coll = self.get_coll('replicator_queue', self.utildb)
-        elif event_type == 'update':
-            coll = self.get_coll('replicator_queue', self.utildb)
-        elif event_type == 'delete':
-            coll = self.get_coll('replicator_queue', self.utildb)
+        coll = self.get_coll('replicator_queue', self.utildb)
+        shard = self.shard_key(schema, table) % self.queue_shards
+        ts = datetime.utcnow() if self.queue_layout == 'ttl' else None
+
+        applied = self.queue_applied.get(shard, -1)
 
-        doc = dict()
-        doc['schema'] = schema
-        doc['table'] = table
-        doc['event_type'] = event_type
-        doc['seqnum'] = seqnum
-        doc['values'] = values
+        docs = list()
+        for index, values in enumerate(rows):
+            if seqnum + index <= applied:
+                continue
+            doc = dict()
+            doc['schema'] = schema
+            doc['table'] = table
+            doc['event_type'] = event_type
+            doc['seqnum'] = seqnum + index
+            doc['shard'] = shard
+            doc['shards'] = self.queue_shards
+            if ts is not None:
+                doc['ts'] = ts
+            doc['values'] = values
+            docs.append(doc)
+
+        if len(docs) < len(rows):
+            self.logger.debug('Skipped ' + str(len(rows) - len(docs)) + ' rows of ' + schema + '.' + table +
+                              ' already applied')
+        if not docs:
+            return seqnum + len(rows) - 1
 
         try:
-            coll.insert_one(doc)
+            coll.insert_many(docs, ordered=False)
+        except BulkWriteError as e:
+            errors = e.details.get('writeErrors', [])
+            duplicates = [error for error in errors if error.get('code') == 11000]
+            if len(duplicates) < len(errors):
+                raise SysException(e)
+            self.logger.info('Skipped ' + str(len(duplicates)) + ' rows of ' + schema + '.' + table +
+                             ' already in queue')
         except Exception as e:
             raise SysException(e)
 
-        return seqnum
+        return seqnum + len(rows) - 1
 
     def insert(self, doc, schema, collection):
         """Insert a document in mongo
@@ -263,6 +391,39 @@ class MyMongoDB:
         except Exception as e:
             raise SysException(e)
 
+    def insert_many(self, docs, schema, collection):
+        """Insert documents in mongo with one unordered bulk insert
+
+        A failing document does not stop the others; failures are logged.
+
+        Args:
+            docs (list): the documents to be inserted
+            schema (str): mongo database name
+            collection (str): mongo collection name
+
+        Returns:
+            int: number of documents inserted
+
+        Raises:
+            :class:`.SysException`
+
+        """
+        if not docs:
+            return 0
+        coll = self.get_coll(collection, schema)
+
+        try:
+            result = coll.insert_many(docs, ordered=False)
+        except BulkWriteError as e:
+            errors = e.details.get('writeErrors', [])
+            self.logger.error('Cannot insert ' + str(len(errors)) + ' of ' + str(len(docs)) +
+                              ' documents into ' + schema + '.' + collection + ', first error: ' + str(errors[:1]))
+            return e.details.get('nInserted', 0)
+        except Exception as e:
+            raise SysException(e)
+
+        return len(result.inserted_ids)
+
     def update(self, doc, schema, collection, primary_key):
         """Update a document in mongo
 
@@ -311,6 +472,24 @@ class MyMongoDB:
             except Exception as e:
                 raise SysException(e)
 
+    def ensure_index(self, keys, schema, collection):
+        """Create an ascending index on some fields of a collection if it does not exist
+
+        Args:
+            keys (list): indexed field names
+            schema (str): mongo database name
+            collection (str): mongo collection name
+
+        Raises:
+            :class:`.SysException`
+
+        """
+        coll = self.get_coll(collection, schema)
+        try:
+            coll.create_index([(k, pymongo.ASCENDING) for k in keys])
+        except Exception as e:
+            raise SysException(e)
+
     def delete_from_queue(self, queue_id):
         """Delete mysql record from mongo queue
 
@@ -331,6 +510,269 @@ class MyMongoDB:
         except Exception as e:
             raise SysException(e)
 
+    def delete_many_from_queue(self, queue_ids):
+        """Delete a batch of mysql records from mongo queue with a single round trip
+
+        Args:
+            queue_ids (list): ids of the records in queue
+
+        Returns:
+            int: number of records deleted
+
+        Raises:
+            :class:`.SysException`
+
+        See Also:
+            :meth:`.delete_from_queue`
+
+        """
+        coll = self.get_coll('replicator_queue', self.utildb)
+
+        try:
+            result = coll.delete_many({'_id': {'$in': queue_ids}})
+        except Exception as e:
+            raise SysException(e)
+
+        return result.deleted_count
+
+    def shard_filter(self):
+        """Filter of the queue records of the shard read by this instance
+
+        Returns:
+            dict: mongo filter, empty without queue shard
+
+        """
+        if self.queue_shard is None:
+            return dict()
+        return {'shard': self.queue_shard}
+
+    def purge_queue(self, seqnum):
+        """Delete the records of the queue up to a sequence number with one range delete
+
+        Used when the queue is consumed as a log: applied records are not deleted one by one
+        but periodically, up to the committed offset.
+        Capped and TTL queues are never purged: mongo drops their oldest records itself.
+
+        Args:
+            seqnum (int): highest sequence number to delete
+
+        Returns:
+            int: number of records deleted
+
+        Raises:
+            :class:`.SysException`
+
+        """
+        if self.queue_layout != 'work':
+            return 0
+
+        coll = self.get_coll('replicator_queue', self.utildb)
+
+        try:
+            query = self.shard_filter()
+            query['seqnum'] = {'$lte': seqnum}
+            result = coll.delete_many(query)
+        except Exception as e:
+            raise SysException(e)
+
+        return result.deleted_count
+
+    def write_queue_offset(self, seqnum):
+        """Commit the sequence number up to which the queue shard of this instance has been applied
+
+        The offset is stored with the queue shard and the number of shards it was committed
+        for, offsets of another number of apply workers are ignored when read.
+
+        Args:
+            seqnum (int): every record of the shard up to this sequence number has been applied
+
+        Raises:
+            :class:`.SysException`
+
+        """
+        coll = self.get_coll('queue_offsets', self.utildb)
+        shard = self.queue_shard or 0
+        try:
+            coll.update_one({'_id': shard}, {'$set': {'seqnum': seqnum, 'shards': self.queue_shards,
+                                                      'updated': datetime.now()}}, upsert=True)
+        except Exception as e:
+            raise SysException(e)
+
+    def read_queue_offset(self):
+        """Get the sequence number up to which the queue shard of this instance has been applied
+
+        Returns:
+            int: committed offset, -1 if none
+
+        Raises:
+            :class:`.SysException`
+
+        """
+        return self.read_queue_offsets().get(self.queue_shard or 0, -1)
+
+    def read_queue_offsets(self):
+        """Get the committed offsets of the queue shards of the current number of apply workers
+
+        Returns:
+            dict: committed offset by queue shard, shards without an offset are missing
+
+        Raises:
+            :class:`.SysException`
+
+        """
+        coll = self.get_coll('queue_offsets', self.utildb)
+        try:
+            docs = list(coll.find({'shards': self.queue_shards}))
+        except Exception as e:
+            raise SysException(e)
+
+        return {doc['_id']: doc['seqnum'] for doc in docs}
+
+    def load_queue_offsets(self):
+        """Load the committed queue offsets, so that the rows already applied are not queued again
+
+        To be called by the replicator before it replays the binlog.
+
+        Raises:
+            :class:`.SysException`
+
+        """
+        self.queue_applied = self.read_queue_offsets()
+
+    def reshard_queue_offsets(self):
+        """Replace the queue offsets committed for another number of apply workers
+
+        A record is only known to be applied below the lowest offset of the old shards, so
+        the shards of the current number that have no offset yet start from there, then the
+        old offsets are deleted. Records applied twice are harmless when applied idempotently.
+
+        Raises:
+            :class:`.SysException`
+
+        """
+        coll = self.get_coll('queue_offsets', self.utildb)
+        stale = {'shards': {'$ne': self.queue_shards}}
+        try:
+            docs = list(coll.find(stale))
+            if not docs:
+                return
+            # 旧的分片中最小的位置 之前的记录都已经处理过
+            seqnum = min(doc['seqnum'] for doc in docs)
+            current = self.read_queue_offsets()
+            for shard in range(self.queue_shards):
+                if shard not in current:
+                    coll.replace_one({'_id': shard}, {'seqnum': seqnum, 'shards': self.queue_shards,
+                                                      'updated': datetime.now()}, upsert=True)
+            coll.delete_many(stale)
+        except Exception as e:
+            raise SysException(e)
+
+        self.logger.info('Moved ' + str(len(docs)) + ' queue offsets to ' + str(self.queue_shards) +
+                         ' shards from seqnum ' + str(seqnum))
+
+    def tail_queue(self, batch_size, await_time=0.1):
+        """Stream the records of a capped replicator queue as they are written
+
+        A tailable await cursor is opened after the highest seqnum read, then every burst of
+        new records is yielded as one batch as soon as it arrives. When nothing arrives for
+        ``await_time`` seconds an empty batch is yielded, so that the caller keeps control.
+        The cursor is opened again after the last record read when it dies (e.g. on an empty
+        collection), and from the new position when :meth:`.seek_queue` moved it back.
+
+        Args:
+            batch_size (int): largest number of records per batch
+            await_time (float): longest wait for new records, in seconds
+
+        Yields:
+            list: queue records in insert order, i.e. in seqnum order
+
+        Raises:
+            :class:`.SysException`
+
+        See Also:
+            :meth:`.get_from_queue`
+
+        """
+        if self.queue_layout != 'capped':
+            raise SysException('Tailable cursors need the capped queue layout')
+
+        coll = self.get_coll('replicator_queue', self.utildb)
+        while True:
+            query = self.shard_filter()
+            query['seqnum'] = {'$gt': self.queue_hwm}
+            try:
+                cursor = coll.find(query, self.queue_fields, cursor_type=CursorType.TAILABLE_AWAIT)
+                cursor.max_await_time_ms(int(await_time * 1000))
+            except Exception as e:
+                raise SysException(e)
+
+            try:
+                while cursor.alive:
+                    queue = list()
+                    try:
+                        # 游标等待超时没有新数据时 迭代结束
+                        for doc in cursor:
+                            queue.append(doc)
+                            if len(queue) >= batch_size:
+                                break
+                    except Exception as e:
+                        raise SysException(e)
+
+                    if queue:
+                        self.queue_hwm = queue[-1]['seqnum']
+                    yield queue
+
+                    if queue and self.queue_hwm != queue[-1]['seqnum']:
+                        # 读取位置被调用方回退 从新的位置重新打开游标
+                        break
+                else:
+                    # 空集合上的游标立即失效 等待之后重新打开
+                    time.sleep(await_time)
+            finally:
+                cursor.close()
+
+    def seek_queue(self, seqnum):
+        """Move the read position of the queue, the next read starts after seqnum
+
+        Args:
+            seqnum (int): last sequence number considered read
+
+        """
+        self.queue_hwm = seqnum
+
+    def bulk_write(self, requests, schema, collection):
+        """Apply a list of write operations to a collection with one ordered bulk write
+
+        Being ordered, the bulk stops at the first failing operation: everything before it
+        has been applied, nothing after it has.
+
+        Args:
+            requests (list): pymongo write operations (InsertOne, ReplaceOne, DeleteOne...)
+            schema (str): mongo database name
+            collection (str): mongo collection name
+
+        Returns:
+            int: number of operations applied, starting from the first one
+
+        Raises:
+            :class:`.SysException`
+
+        """
+        coll = self.get_coll(collection, schema)
+
+        try:
+            coll.bulk_write(requests, ordered=True)
+        except BulkWriteError as e:
+            errors = e.details.get('writeErrors', [])
+            self.logger.error('Bulk write on ' + schema + '.' + collection + ' failed: ' + str(errors[:1]))
+            if errors:
+                return errors[0]['index']
+            return 0
+        except Exception as e:
+            raise SysException(e)
+
+        return len(requests)
+
     def drop_db(self, db_name):
         """Drop mongo database
         Args:
@@ -359,14 +801,50 @@ class MyMongoDB:
         except Exception as e:
             raise SystemError(e)
 
+    @staticmethod
+    def shard_key(schema, table):
+        """Stable hash of a table, used to split the replicator queue between apply workers
+
+        All the events of a table have the same key, so a table is always applied by the
+        same worker, in seqnum order.
+
+        Args:
+            schema (str): mysql database name
+            table (str): mysql table name
+
+        Returns:
+            int: shard key of the table
+
+        """
+        return zlib.crc32(f"{schema}.{table}".encode())
+
+    def set_queue_shard(self, index, count):
+        """Set the number of queue shards, and restrict the queue reads to one of them
+
+        The records are written with their shard number, ``shard_key % count``, so that a
+        worker reads its shard with an equality on the ``(shard, seqnum)`` index.
+
+        Args:
+            index (int): shard read by this instance, from 0 to count - 1, None for a writer
+            count (int): number of shards, 1 reads the whole queue
+
+        """
+        self.queue_shards = max(count, 1)
+        self.queue_shard = index if count > 1 else None
+
     def get_from_queue(self, batch_size):
         """Gets a batch size number or records from mongo queue
 
+        Records are read in seqnum order starting after the highest seqnum already returned
+        by this instance, with a range query on the seqnum index. The consumer moves the mark
+        back with :meth:`.seek_queue` when records could not be applied.
+        With a queue shard set, only the records of the tables of that shard are read.
+
         Args:
             batch_size (int): number of recordds to retrieve from queue
 
         Returns:
-            cursor: pymongo cursor with search results
+            list: queue records
 
         Raises:
             :class:`.SysException`
@@ -377,10 +855,16 @@ class MyMongoDB:
         """
         coll = self.get_coll('replicator_queue', self.utildb)
         try:
-            queue = coll.find().sort('seqnum', 1)[0:batch_size]
+            query = self.shard_filter()
+            query['seqnum'] = {'$gt': self.queue_hwm}
+            cursor = coll.find(query, self.queue_fields)
+            queue = list(cursor.sort('seqnum', 1).limit(batch_size).batch_size(batch_size))
         except Exception as e:
             raise SysException(e)
 
+        if queue:
+            self.queue_hwm = queue[-1]['seqnum']
+
         return queue
 
     def insert_primary_key(self, doc):
@@ -443,6 +927,25 @@ class MyMongoDB:
 
         return primary
 
+    def write_metrics(self, name, metrics):
+        """Publish the runtime metrics of a process to utildb
+
+        Args:
+            name (str): name of the process publishing the metrics
+            metrics (dict): metric values
+
+        Raises:
+            :class:`.SysException`
+
+        """
+        coll = self.get_coll('metrics', self.utildb)
+        doc = dict(metrics)
+        doc['updated'] = datetime.now()
+        try:
+            coll.replace_one({'_id': name}, doc, True)
+        except Exception as e:
+            raise SysException(e)
+
     def make_db_as_parsed(self, db, parse_type):
         """Write to utildb if the db has been parsed and which part of it (schema, data, both)
 
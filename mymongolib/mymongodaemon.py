@@ -13,6 +13,7 @@ from mymongolib.daemon import Daemon
 from mymongolib import mysql
 from mymongolib.mongodb import MyMongoDB
 from mymongolib.datamunging import DataMunging
+from mymongolib.checkpoint import Checkpointer
 from mymongomodules.parse_data import ParseData
 from mymongomodules.process_data import ProcessData
 
@@ -45,8 +46,21 @@ class MyMongoDaemon(Daemon):
     
         self.logger.info("Running")
 
+        # 每个 datamunging 进程一个通知队列 按表分片
+        self.apply_workers = max(config['general'].getint('apply_workers', fallback=1), 1)
+
+        # 一次性初始化工具集合和索引 各进程的热路径上不再检查集合
+        try:
+            mongo = MyMongoDB(config['mongodb'])
+            mongo.set_queue_shard(None, self.apply_workers)
+            mongo.bootstrap()
+        except Exception as e:
+            self.logger.error('Cannot bootstrap mongo utility collections. Error: ' + str(e))
+        # direct 模式下数据直接通过进程队列发送 不再写入 mongo 队列; 队列有上限 处理慢时复制进程等待
+        self.direct = config['general'].get('pipeline', fallback='queue') == 'direct'
+        maxsize = config['general'].getint('direct_queue_size', fallback=1000) if self.direct else 0
         self.queues = dict()
-        self.queues['replicator_out'] = Queue()
+        self.queues['replicator_out'] = [Queue(maxsize) for _ in range(self.apply_workers)]
 
         procs = dict()  # 进程字典
         procs['scheduler'] = Process(name='scheduler', target=self.scheduler)
@@ -57,9 +71,11 @@ class MyMongoDaemon(Daemon):
         procs['replicator'].daemon = True
         procs['replicator'].start()
 
-        procs['datamunging'] = Process(name='datamunging', target=self.data_munging)
-        procs['datamunging'].daemon = True
-        procs['datamunging'].start()
+        for shard in range(self.apply_workers):
+            name = 'datamunging' if self.apply_workers == 1 else f'datamunging_{shard}'
+            procs[name] = Process(name=name, target=self.data_munging, args=(shard,))
+            procs[name].daemon = True
+            procs[name].start()
 
         procs['dataprocess'] = Process(name='dataprocess', target=self.data_process)
         procs['dataprocess'].daemon = True
@@ -119,13 +135,17 @@ class MyMongoDaemon(Daemon):
             setproctitle.setproctitle('mymongo_replicator')
 
         mongo = MyMongoDB(config['mongodb'])
+        mongo.set_queue_shard(None, self.apply_workers)
         # 将 binlog 数据写入的过程
-        mysql.mysql_stream(config['mysql'], mongo, self.queues['replicator_out'])
+        mysql.mysql_stream(config['mysql'], mongo, self.queues['replicator_out'], direct=self.direct)
 
-    def data_munging(self):
+    def data_munging(self, shard=0):
         # 读取要插入的数据 并且写入mongo
         """Reads data from replpication queue and writes to mongo
 
+        Args:
+            shard (int): queue shard applied by this process
+
         See Also:
             :meth:`.replicator`
 
@@ -134,12 +154,26 @@ class MyMongoDaemon(Daemon):
         self.write_pid(str(os.getpid()))
         if self.setproctitle:
             import setproctitle
-            setproctitle.setproctitle('mymongo_datamunging')
+            setproctitle.setproctitle('mymongo_datamunging' if self.apply_workers == 1 else f'mymongo_datamunging_{shard}')
 
         module_instance = ParseData()
 
         mongo = MyMongoDB(config['mongodb'])
-        munging = DataMunging(mongo, self.queues['replicator_out'])
+        checkpointer = None
+        if self.direct:
+            checkpointer = Checkpointer(mongo,
+                                        interval=config['mysql'].getint('checkpoint_interval', fallback=1000),
+                                        max_events=config['mysql'].getint('checkpoint_events', fallback=1000))
+        munging = DataMunging(mongo, self.queues['replicator_out'][shard],
+                              min_batch_size=config['general'].getint('min_batch_size', fallback=100),
+                              max_batch_size=config['general'].getint('max_batch_size', fallback=5000),
+                              min_backoff=config['general'].getfloat('min_backoff', fallback=0.05),
+                              max_backoff=config['general'].getfloat('max_backoff', fallback=5),
+                              shard=shard,
+                              shards=self.apply_workers,
+                              idempotent=config['general'].get('apply_mode', fallback='delete') == 'idempotent',
+                              tail=config['general'].get('queue_consumer', fallback='poll') == 'tail',
+                              checkpointer=checkpointer)
         # module_instance 的 run 是对数据的解析 暂时没有做解析 具体在 ParseData() 类中做处理
         munging.run(module_instance)
 
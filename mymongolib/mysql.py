@@ -1,18 +1,35 @@
+import re
 import signal
 import sys
+import time
 import logging
 import decimal
 import datetime
 
+from bson import ObjectId
 from pymysqlreplication import BinLogStreamReader
+from pymysqlreplication.event import HeartbeatLogEvent
 from pymysqlreplication.row_event import (
     DeleteRowsEvent,
     UpdateRowsEvent,
     WriteRowsEvent,
 )
 
+from .checkpoint import Checkpointer
+from .utils import bson_value, dump_table_types, field_converters
 
-def mysql_stream(conf, mongo, queue_out):
+
+def mysql_stream(conf, mongo, queues_out, direct=False):
+    """Replicate the binlog events of the configured tables
+
+    Args:
+        conf (object): mysql section of the configuration
+        mongo (object): :class:`.MyMongoDB` instance
+        queues_out (list): multiprocessing queues read by the data munging workers, one per shard
+        direct (bool): send the rows to the workers through ``queues_out`` instead of the mongo
+            queue; the binlog positions are then checkpointed by the workers once applied
+
+    """
     logger = logging.getLogger(__name__)
 
     # server_id is your slave identifier, it should be unique.
@@ -27,67 +44,294 @@ def mysql_stream(conf, mongo, queue_out):
         "passwd": conf['password']
     }
 
-    res_dict = dict()
-    dbs = conf['databases'].split(",")
-    tables = ['already_table']
+    dbs = [db.strip() for db in conf['databases'].split(",")]
+    tables = eval(conf['already_table'])  # 可以进行增量更新的 table
 
+    # 每张表各自记录复制的位置 所有的表共用一个 binlog 连接
+    # routes: "db.table" --> 该表已经处理到的位置 追上之后置为 None
+    routes = dict()
     for db in dbs:
         for table in tables:
-            res_dict.update({table: mongo.get_log_pos(db, table)})
+            log_file, log_pos, resume_stream = mongo.get_log_pos(db, table)
+            if resume_stream:
+                routes[f"{db}.{table}"] = binlog_position(log_file, log_pos)
+            else:
+                logger.warning(f"No log position for {db}.{table}, replicate it from the stream start")
+                routes[f"{db}.{table}"] = None
+    # 已经追上自己位置的表 每处理一个事件 这些表的位置都随之前进
+    live = [name for name, pos in routes.items() if pos is None]
 
-    for db in dbs:
-        for table in tables:
-            log_file, log_pos, resume_stream = res_dict.get(table)
-
-            stream = BinLogStreamReader(connection_settings=mysql_settings,
-                                        server_id=conf.getint('slaveid'),
-                                        only_events=[DeleteRowsEvent, WriteRowsEvent, UpdateRowsEvent],
-                                        blocking=True,
-                                        resume_stream=resume_stream,
-                                        log_file=log_file,
-                                        log_pos=log_pos,
-                                        only_tables=table,   # 只查询当前表的事件
-                                        only_schemas=db)  # 只查询当前的数据库
-
-            for binlogevent in stream:
-                binlogevent.dump()
-                schema = "%s" % binlogevent.schema
-                table = "%s" % binlogevent.table
-
-                # event_type, vals = None, None
-                for row in binlogevent.rows:
-                    if isinstance(binlogevent, DeleteRowsEvent):
-                        vals = process_binlog_dict(row["values"])
-                        event_type = 'delete'
-                    elif isinstance(binlogevent, UpdateRowsEvent):
-                        vals = dict()
-                        vals["before"] = process_binlog_dict(row["before_values"])
-                        vals["after"] = process_binlog_dict(row["after_values"])
-                        event_type = 'update'
-                    elif isinstance(binlogevent, WriteRowsEvent):
-                        vals = process_binlog_dict(row["values"])
-                        event_type = 'insert'
-
-                    # 将事件类型和记录数值写入数据库中 将返回的 _id 当做序列号返回
-                    seqnum = mongo.write_to_queue(event_type, vals, schema, table)
-
-                    # 刷新 log 日志的位置
-                    mongo.write_log_pos(stream.log_file, stream.log_pos, db, table)
-                    # 将 _id 作为 seqnum 插入队列中
-                    queue_out.put({'seqnum': seqnum})
-
-                    logger.debug(f"------row------{row}")
-                    logger.debug(f"------stream.log_pos------{stream.log_pos}")
-                    logger.debug(f"------stream.log_file------{stream.log_file}")
-
-    stream.close()
-
-
-# 将非int数据全部转换为 str后续可能在导入的时候转换 则这里就是全部为 str
-def process_binlog_dict(_dict):
+    # 从所有表中最早的位置开始读取 之前已经处理过的事件由各表自己跳过
+    positions = [pos for pos in routes.values() if pos is not None]
+    if positions:
+        log_file, log_pos = min(positions)
+        resume_stream = True
+    else:
+        log_file, log_pos, resume_stream = None, None, False
+    logger.info(f"Start binlog stream of {len(routes)} tables from {log_file}:{log_pos}")
+
+    # 定时写入位置; binlog 空闲时 master 按同样的间隔发送心跳事件
+    heartbeat = conf.getint('checkpoint_interval', fallback=1000) / 1000
+    beaten = time.time()
+
+    stream = BinLogStreamReader(connection_settings=mysql_settings,
+                                server_id=conf.getint('slaveid'),
+                                only_events=[DeleteRowsEvent, WriteRowsEvent, UpdateRowsEvent, HeartbeatLogEvent],
+                                blocking=True,
+                                slave_heartbeat=heartbeat,
+                                resume_stream=resume_stream,
+                                log_file=log_file,
+                                log_pos=log_pos,
+                                only_tables=tables,   # 只查询配置的表的事件
+                                only_schemas=dbs)  # 只查询配置的数据库
+
+    # 位置只在内存中合并 定时或定量批量写入; 退出时一定写入
+    # 每张表的类型转换 与导入的数据类型一致
+    converters = dict()
+
+    # direct 模式下由处理进程在写入 mongo 之后记录位置
+    checkpointer = Checkpointer(mongo,
+                                interval=conf.getint('checkpoint_interval', fallback=1000),
+                                max_events=conf.getint('checkpoint_events', fallback=1000))
+    if direct:
+        checkpointer = None
+    else:
+        # 已经处理并从队列中删除的记录 重放时不再写入队列
+        mongo.load_queue_offsets()
+
+    def shutdown(signum, frame):
+        logger.info(f"Replicator got signal {signum}, checkpoint and exit")
+        sys.exit(0)
+
+    signal.signal(signal.SIGTERM, shutdown)
+
+    try:
+        for binlogevent in stream:
+            if isinstance(binlogevent, HeartbeatLogEvent):
+                if direct:
+                    # 向所有 worker 发送位置 没有事件的分片也能前进
+                    if time.time() - beaten >= heartbeat:
+                        send_position(stream, queues_out, live)
+                        beaten = time.time()
+                else:
+                    checkpointer.tick()
+                continue
+
+            schema = "%s" % binlogevent.schema
+            table = "%s" % binlogevent.table
+            name = f"{schema}.{table}"
+
+            if name not in routes:
+                continue
+
+            checkpoint = routes[name]
+            if checkpoint is not None:
+                if binlog_position(stream.log_file, stream.log_pos) <= checkpoint:
+                    logger.debug(f"Skip event of {name} at {stream.log_file}:{stream.log_pos}, already replicated")
+                    continue
+                routes[name] = None
+                live.append(name)
+
+            if name not in converters:
+                converters[name] = field_converters(dump_table_types(table, schema, mongo))
+
+            if direct:
+                send_rows_event(binlogevent, stream, mongo, queues_out, live, converters[name])
+                if time.time() - beaten >= heartbeat:
+                    send_position(stream, queues_out, live)
+                    beaten = time.time()
+                continue
+            process_rows_event(binlogevent, stream, mongo, queues_out, converters[name])
+            checkpointer.update(live, stream.log_file, stream.log_pos)
+    finally:
+        if checkpointer is not None:
+            try:
+                checkpointer.flush()
+            except Exception as e:
+                logger.error(f"Cannot write the last log positions. Error: {e}")
+        stream.close()
+
+
+def process_rows_event(binlogevent, stream, mongo, queues_out, converters=None):
+    """Write all the rows of a binlog rows event to the replicator queue
+
+    Args:
+        binlogevent (object): pymysqlreplication rows event
+        stream (object): BinLogStreamReader which produced the event
+        mongo (object): :class:`.MyMongoDB` instance
+        queues_out (list): multiprocessing queues read by the data munging workers, one per shard
+        converters (dict): converter of the typed columns of the table, see :func:`.field_converters`
+
+    """
+    logger = logging.getLogger(__name__)
+    schema = "%s" % binlogevent.schema
+    table = "%s" % binlogevent.table
+
+    # 一个事件中的所有行 一次性写入队列
+    event_type, rows = event_rows(binlogevent, converters)
+    if not rows:
+        return
+
+    # 将事件类型和记录数值批量写入数据库中 返回最后一行的序列号
+    first = binlog_seqnum(binlogevent.packet.log_pos, binlogevent.packet.event_size, stream.log_file)
+    seqnum = mongo.write_batch_to_queue(event_type, rows, schema, table, first)
+
+    # 每个事件只通知一次 只通知处理该表的 worker
+    shard = mongo.shard_key(schema, table) % len(queues_out)
+    queues_out[shard].put({'seqnum': seqnum, 'count': len(rows)})
+
+    logger.debug(f"------{schema}.{table} rows------{len(rows)}")
+    logger.debug(f"------stream.log_pos------{stream.log_pos}")
+    logger.debug(f"------stream.log_file------{stream.log_file}")
+
+
+def send_rows_event(binlogevent, stream, mongo, queues_out, live, converters=None):
+    """Send all the rows of a binlog rows event straight to the data munging worker of its table
+
+    The rows are sent as queue records, like the ones read back from the mongo queue, along
+    with the binlog position reached and the tables replicated up to it, which the worker
+    checkpoints once the rows are applied.
+
+    Args:
+        binlogevent (object): pymysqlreplication rows event
+        stream (object): BinLogStreamReader which produced the event
+        mongo (object): :class:`.MyMongoDB` instance
+        queues_out (list): multiprocessing queues read by the data munging workers, one per shard
+        live (list): ``db.table`` names replicated up to the event
+        converters (dict): converter of the typed columns of the table, see :func:`.field_converters`
+
+    """
+    schema = "%s" % binlogevent.schema
+    table = "%s" % binlogevent.table
+
+    event_type, rows = event_rows(binlogevent, converters)
+    if not rows:
+        return
+
+    first = binlog_seqnum(binlogevent.packet.log_pos, binlogevent.packet.event_size, stream.log_file)
+    # ObjectId 记录发送时间 用于计算延迟
+    records = [{'_id': ObjectId(), 'schema': schema, 'table': table, 'event_type': event_type,
+                'seqnum': first + index, 'values': values} for index, values in enumerate(rows)]
+
+    # 队列满时阻塞 处理进程跟不上时复制进程随之等待
+    shard = mongo.shard_key(schema, table) % len(queues_out)
+    queues_out[shard].put({'records': records, 'log_file': stream.log_file, 'log_pos': stream.log_pos,
+                           'live': list(live)})
+
+
+def send_position(stream, queues_out, live):
+    """Send the binlog position reached to every data munging worker of the direct pipeline
+
+    Every event before the position has already been sent to the worker of its table, so
+    each worker checkpoints its tables once it has applied the records received before,
+    even when none of its tables had an event for a while.
+
+    Args:
+        stream (object): BinLogStreamReader
+        queues_out (list): multiprocessing queues read by the data munging workers, one per shard
+        live (list): ``db.table`` names replicated up to the position
+
+    """
+    msg = {'records': [], 'log_file': stream.log_file, 'log_pos': stream.log_pos, 'live': list(live)}
+    for queue_out in queues_out:
+        queue_out.put(msg)
+
+
+def event_rows(binlogevent, converters=None):
+    """Values of the rows of a binlog rows event
+
+    Args:
+        binlogevent (object): pymysqlreplication rows event
+        converters (dict): converter of the typed columns of the table, see :func:`.field_converters`
+
+    Returns:
+        tuple: (event_type, rows), with ``before`` and ``after`` values for the update rows;
+            rows is empty for unknown events
+
+    """
+    if isinstance(binlogevent, DeleteRowsEvent):
+        event_type = 'delete'
+    elif isinstance(binlogevent, UpdateRowsEvent):
+        event_type = 'update'
+    elif isinstance(binlogevent, WriteRowsEvent):
+        event_type = 'insert'
+    else:
+        return None, list()
+
+    rows = list()
+    for row in binlogevent.rows:
+        if event_type == 'update':
+            vals = dict()
+            vals["before"] = process_binlog_dict(row["before_values"], converters)
+            vals["after"] = process_binlog_dict(row["after_values"], converters)
+        else:
+            vals = process_binlog_dict(row["values"], converters)
+        rows.append(vals)
+
+    return event_type, rows
+
+
+def binlog_seqnum(log_pos, event_size, log_file):
+    """Sequence number of the first row of a binlog event
+
+    The number is derived from the binlog coordinates of the event: the index of the
+    binlog file in the high 32 bits and the start position of the event in the low ones.
+    Every row of an event takes at least one byte, so ``seqnum + row_index`` stays below
+    the start of the next event: numbers are strictly increasing, survive clock changes,
+    and replaying the same events gives the same numbers.
+
+    Args:
+        log_pos (int): position of the end of the event in the log file
+        event_size (int): size of the event in bytes, header included
+        log_file (str): mysql binlog file name, like ``bin.000025``
+
+    Returns:
+        int: sequence number of the first row of the event
+
+    """
+    file_index = int(re.search(r'(\d+)$', log_file).group(1))
+    return (file_index << 32) + log_pos - event_size
+
+
+def binlog_position(log_file, log_pos):
+    """Comparable binlog coordinates
+
+    Binlog file names share the same prefix and a zero padded index, so (file, pos)
+    tuples sort in the order the events were written.
+
+    Args:
+        log_file (str): mysql binlog file name
+        log_pos: position in the log file, as int or str
+
+    Returns:
+        tuple: (log_file, log_pos)
+
+    """
+    return log_file, int(log_pos)
+
+
+def process_binlog_dict(_dict, converters=None):
+    """Convert the values of a binlog row like the loaders convert the loaded rows
+
+    Typed columns go through the converter of their type, the other values are converted
+    to a type mongo can store, so that the documents of the binlog and of the loaders have
+    the same types and the whole row filters of the tables without primary key match.
+
+    Args:
+        _dict (dict): row values
+        converters (dict): converter of the typed columns of the table, see :func:`.field_converters`
+
+    Returns:
+        dict: the converted row
+
+    """
+    converters = converters or dict()
     for k, v in _dict.items():
-        if not isinstance(v, int):
-            _dict.update({k: str(v)})
+        convert = converters.get(k, bson_value)
+        try:
+            _dict[k] = convert(v)
+        except (ValueError, TypeError):
+            _dict[k] = v
     return _dict
 
 # # 因为是使用 csv 文档插入 所有不再对数据的类型做出校验
@@ -4,11 +4,18 @@ import subprocess
 import datetime
 import os
 import re
+import sys
 import time
-import csv
+import decimal
+import queue
 
-from tempfile import NamedTemporaryFile
+import pymysql
+
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from multiprocessing import Process, Queue
 from lxml import etree
+from pymysql.cursors import SSCursor
 
 from mymongolib.mongodb import MyMongoDB
 from .exceptions import SysException
@@ -51,6 +58,14 @@ def cmd_parser():
 
     parser.add_argument('--load-data', dest='load_data',
                         action='store_true', help="dump csv file from mysql and import it to mongo", default=False)
+    parser.add_argument('--load-workers', dest='load_workers', type=int,
+                        help="Number of tables loaded at the same time by --load-data", default=None)
+    parser.add_argument('--load-mode', dest='load_mode', choices=['csv', 'stream', 'snapshot', 'chunked'],
+                        help="csv: export a txt file and import it with typed values, stream: stream rows from mysql \
+                        to mongo without intermediate files, snapshot: stream rows from a consistent \
+                        snapshot, tables can be loaded under live traffic, chunked: load snapshots of \
+                        primary key ranges in parallel, an interrupted load resumes from the \
+                        unfinished chunks", default=None)
     return parser
 
 
@@ -94,100 +109,797 @@ def mysqlcsv_cmd(table, conf):
     return temp_file
 
 
-def txt2csv(file):
-    w_file = open(file.split(".")[0]+".csv", "w")
-    # print(w_file)
-    writer_file = csv.writer(w_file)
-
+def write_utils(conf, table, file, pos):
+    mongo = MyMongoDB(conf)
+    # for example: { "name" : “database.table”, "log_file" : "mysql-bin.000007", "log_pos" : 28084 }
+    info = {"log_file": file, "log_pos": pos}
+    pri = {"name": f"{conf['databases']}.{table}"}
     try:
-        with open(file) as f:
-            f_csv = csv.reader(f)
-            headers = next(f_csv)
-            # 处理表头
-            writer_file.writerow(headers[0].split())
-            # 处理 row
-            for row in f_csv:
-                writer_file.writerow(row[0].split("\t"))
+        coll = mongo.get_coll(conf['mysqllog'], conf['utildb'])
+        coll.update(pri, {"$set": info}, upsert=True)
     except Exception as e:
+        # print(e)
         raise SystemError(e)
-    finally:
-        pass
-        # 关闭写入流
-        #  writer_file.close()
-    return w_file.name
+    return True
 
 
-def import2mongo(file, table, conf):
-    # mongoimport --host=127.0.0.1 --db datacenter --collection table1 --type csv --headerline --ignoreBlanks --file table1.csv
-    showposcommand = f"mongoimport --host={conf['host']} --db {conf['databases']} --collection {table} --type csv --headerline --ignoreBlanks --file {file}"
-    # print(showposcommand)
+def column_type_name(sql_type):
+    """Classify a mysql column type as recorded in the ``types`` map of ``primary_keys``
 
-    # drop collection if exist...
-    mongo = MyMongoDB(conf)
+    Args:
+        sql_type (str): mysql column type, like ``int(11)`` or ``decimal(20,4)``
+
+    Returns:
+        str: int, datetime, decimal, longblob, float, time, or None for the other types
+
+    """
+    if re.match(r'(tiny|small|medium|big)?int\b', sql_type):
+        return "int"
+    elif 'datetime' in sql_type or 'timestamp' in sql_type or re.match(r'date\b', sql_type):
+        # PyMySQL 将 timestamp 读为 datetime; date 与 bson_value 一样存为当天零点
+        return "datetime"
+    elif "decimal" in sql_type:
+        return "decimal"
+    elif "longblob" in sql_type:
+        return "longblob"
+    elif re.match(r'(float|double|real)\b', sql_type):
+        return "float"
+    elif "time" in sql_type:
+        return "time"
+    return None
+
+
+def to_int(value):
+    if value is None or isinstance(value, int):
+        return value
+    return int(value)
+
+
+def to_float(value):
+    if value is None:
+        return value
+    return float(value)
+
+
+def to_datetime(value):
+    if value is None or isinstance(value, datetime.datetime):
+        return value
+    if isinstance(value, datetime.date):
+        return datetime.datetime(value.year, value.month, value.day)
+    if len(value) == 10:
+        # date 列 "2019-08-01"
+        return datetime.datetime.strptime(value, "%Y-%m-%d")
+    return datetime.datetime.strptime(value, "%Y-%m-%d %H:%M:%S")
+
+
+def to_time(value):
+    # "09:00:00" --> datetime.timedelta --> "9:00:00"
+    if isinstance(value, datetime.timedelta):
+        return str(value)
+    if isinstance(value, str) and value.startswith("0"):
+        return value[1:]
+    return value
+
+
+def bson_value(value):
+    """Convert a value read from PyMySQL to a type mongo can store"""
+    if isinstance(value, decimal.Decimal):
+        return float(value)
+    elif isinstance(value, datetime.timedelta):
+        # datetime.timedelta --> "9:00:00"
+        return str(value)
+    elif isinstance(value, datetime.date) and not isinstance(value, datetime.datetime):
+        return datetime.datetime(value.year, value.month, value.day)
+    elif isinstance(value, set):
+        # binlog 中的 SET 列 PyMySQL 读出的是逗号分隔的文本
+        return ','.join(sorted(value))
+    return value
+
+
+# primary_keys 中记录的类型 --> 转换函数 值可以是文本或者 PyMySQL 读出的值
+CONVERTERS = {
+    'int': to_int,
+    'datetime': to_datetime,
+    'decimal': to_float,
+    'float': to_float,
+    'time': to_time,
+}
+
+
+def conversion_plan(columns, types):
+    """Build the conversion plan of a table once, to apply it to every batch of rows
+
+    Args:
+        columns (list): column names, in the order of the row values
+        types (dict): type of each column, as in the ``types`` map of ``primary_keys``
+
+    Returns:
+        list: (column, converter) for each column
+
+    """
+    return [(column, CONVERTERS.get(types.get(column), bson_value)) for column in columns]
+
+
+def convert_rows(rows, plan):
+    """Convert a batch of rows to mongo documents with native types
+
+    A value which cannot be converted is kept as it is.
+
+    Args:
+        rows (list): row values, in the order of the plan
+        plan (list): conversion plan from :func:`.conversion_plan`
+
+    Returns:
+        list: documents
+
+    """
     try:
-        mongo.drop_coll(conf['databases'], table)
-    except Exception:
-        pass
+        return [{column: convert(value) for (column, convert), value in zip(plan, row)} for row in rows]
+    except (ValueError, TypeError):
+        return [convert_row(row, plan) for row in rows]
+
+
+def convert_row(row, plan):
+    doc = dict()
+    for (column, convert), value in zip(plan, row):
+        try:
+            doc[column] = convert(value)
+        except (ValueError, TypeError):
+            doc[column] = value
+    return doc
+
+
+def field_converters(types):
+    """Compile the converter of each typed column of a table
+
+    Args:
+        types (dict): type of each column, as in the ``types`` map of ``primary_keys``
+
+    Returns:
+        dict: converter by column name, columns without a converter are kept as text
+
+    """
+    return {column: CONVERTERS[type_name] for column, type_name in types.items() if type_name in CONVERTERS}
+
+
+def dump_table_types(table, db, mongodb):
+    """Column types of a table parsed from a dump, read once per table from ``primary_keys``
+
+    Returns:
+        dict: type of each column, empty if the schema of the table has not been parsed
+
+    """
+    key = mongodb.get_type_info(table, db)
+    if key is None:
+        logger.warning('No type info for ' + db + '.' + table + ', its values are imported as text')
+        return dict()
+    return key.get("types", dict())
 
+
+def table_types(table, conf1, mongo):
+    """Column types of a table, from ``primary_keys`` or else from mysql information_schema
+
+    Without a ``primary_keys`` document, as when the data is loaded with ``--load-data``
+    rather than from a mysqldump schema, the primary key and the column types read from
+    information_schema are recorded in ``primary_keys``, so that the replication applies the
+    events of the table by primary key.
+
+    Returns:
+        dict: type of each column, see :func:`.column_type_name`
+
+    Raises:
+        :class:`.SysException`
+
+    """
+    db = conf1["mysql"]['databases'].strip()
+    key = mongo.get_type_info(table, db)
+    if key is not None and key.get("types"):
+        return key["types"]
+
+    connection = mysql_connect(conf1["mysql"])
     try:
-        p1 = subprocess.Popen(showposcommand, shell=True)
-    except Exception as e:
-        logger.warning(f"fail to import to mongodb, because {e}")
-        # raise SystemError(e)
-        return None
-    p1.wait()
+        with connection.cursor() as cursor:
+            cursor.execute("select column_name, column_type, column_key from information_schema.columns "
+                           "where table_schema = %s and table_name = %s order by ordinal_position", (db, table))
+            columns = cursor.fetchall()
+    finally:
+        connection.close()
+
+    doc = dict()
+    doc['_id'] = db + '.' + table
+    doc['primary_key'] = []
+    doc['table'] = table
+    doc['db'] = db
+    doc["types"] = dict()
+    for column, sql_type, column_key in columns:
+        if column_key == 'PRI':
+            doc['primary_key'].append(column)
+        type_name = column_type_name(sql_type)
+        if type_name is not None:
+            doc["types"][column] = type_name
+
+    if columns:
+        # 与解析 mysqldump 结构时一样记录主键 复制时按主键处理
+        mongo.insert_primary_key(doc)
+    return doc["types"]
+
+
+def read_mysql_txt(file, batch_size):
+    """Read the tab separated output of ``mysql -e`` by batches of rows
+
+    Args:
+        file (str): file written by :func:`.mysqlcsv_cmd`
+        batch_size (int): number of rows per batch
+
+    Yields:
+        tuple: (columns, rows)
+
+    """
+    def unescape(value):
+        if value == 'NULL':
+            return None
+        if '\\' not in value:
+            return value
+        return MYSQL_ESCAPE.sub(lambda m: MYSQL_UNESCAPE.get(m.group(1), m.group(1)), value)
+
+    with open(file) as f:
+        columns = f.readline().rstrip('\n').split('\t')
+        rows = list()
+        for line in f:
+            rows.append([unescape(value) for value in line.rstrip('\n').split('\t')])
+            if len(rows) >= batch_size:
+                yield columns, rows
+                rows = list()
+        if rows:
+            yield columns, rows
+
+
+MYSQL_ESCAPE = re.compile(r'\\(.)')
+MYSQL_UNESCAPE = {'n': '\n', 't': '\t', '0': '\0', '\\': '\\'}
+
+
+def import_txt(file, table, conf1):
+    """Import the ``mysql -e`` export of a table into mongo with native types
+
+    Args:
+        file (str): file written by :func:`.mysqlcsv_cmd`
+        table (str): mysql table name
+        conf1 (object): whole configuration
+
+    Returns:
+        bool: True if the file has been imported
+
+    """
+    db = conf1["mysql"]['databases'].strip()
+    mongo = MyMongoDB(conf1['mongodb'])
+    types = table_types(table, conf1, mongo)
+    mongo.drop_coll(db, table)
+
+    plan = None
+    for columns, rows in read_mysql_txt(file, conf1["mysql"].getint('load_batch_size', fallback=5000)):
+        if plan is None:
+            plan = conversion_plan(columns, types)
+        mongo.insert_many(convert_rows(rows, plan), db, table)
     return True
 
 
-def write_utils(conf, table, file, pos):
-    mongo = MyMongoDB(conf)
-    # for example: { "name" : “database.table”, "log_file" : "mysql-bin.000007", "log_pos" : 28084 }
-    info = {"log_file": file, "log_pos": pos}
-    pri = {"name": f"{conf['databases']}.{table}"}
+def load_table(table, conf1):
+    """Load one mysql table into mongo through a txt export
+
+    Args:
+        table (str): mysql table name
+        conf1 (object): whole configuration
+
+    Returns:
+        bool: True if the table has been loaded
+
+    """
+    conf = conf1["mysql"]
+    logger.debug(f"begin load data from table {table}")
+    # 步骤1 ： 生成同步前的记录文件
+    temp_file_1 = mysqlinfo_cmd(table, conf)
+
+    # 步骤2： 记录同步前的 file 和 pos
+    file1, pos1 = read_txt(temp_file_1)
+    logger.debug(f"before------->{table}: {file1}=={pos1}")
+
+    # 步骤3： 导出 txt 格式数据
+    txt_file = mysqlcsv_cmd(table, conf)
+
+    # 步骤4： 生成同步之后的记录文件
+    temp_file_2 = mysqlinfo_cmd(table, conf)
+
+    # 步骤5： 记录同步后的 file 和 pos
+    file2, pos2 = read_txt(temp_file_2)
+    logger.debug(f"after------->{table}: {file2}=={pos2}")
+    write_utils(conf1["mongodb"], table, file1, pos1)
+
+    # 步骤6：判断是否一致
+    if file1 == file2 and pos1 == pos2:
+        # 步骤7: 按照列的类型转换后导入 mongodb (不再经过 csv 和 mongoimport 猜测类型)
+        # 步骤8: 将文件和位置信息写入 util 数据库
+        if import_txt(txt_file, table, conf1) and write_utils(conf1["mongodb"], table, file1, pos1):
+            return True
+
+    logger.warning(f"table {table} has not been loaded")
+    return False
+
+
+def mysql_connect(conf, cursorclass=None):
+    """Open a PyMySQL connection on the replicated database
+
+    Args:
+        conf (object): mysql section of the configuration
+        cursorclass (object): PyMySQL cursor class, SSCursor streams the results
+
+    Returns:
+        object: PyMySQL connection
+
+    """
+    kwargs = dict()
+    if cursorclass is not None:
+        kwargs['cursorclass'] = cursorclass
     try:
-        coll = mongo.get_coll(conf['mysqllog'], conf['utildb'])
-        coll.update(pri, {"$set": info}, upsert=True)
+        return pymysql.connect(host=conf['host'], port=conf.getint('port'), user=conf['user'],
+                               passwd=conf['password'], db=conf['databases'].strip(),
+                               charset='utf8', **kwargs)
     except Exception as e:
-        # print(e)
-        raise SystemError(e)
-    return True
+        raise SysException(e)
+
+
+def master_status(cursor):
+    """Read the current binlog coordinates of mysql
+
+    Returns:
+        tuple: (log_file, log_pos)
+
+    """
+    cursor.execute("show master status")
+    row = cursor.fetchall()[0]
+    return row[0], row[1]
+
+
+class SnapshotPool:
+    """Connections reading the same consistent snapshot of mysql
+
+    The global read lock is taken once, all the snapshot transactions are opened and the
+    binlog coordinates are read under it, then it is released. On a live primary the
+    ``FLUSH TABLES WITH READ LOCK`` waits for the running selects and every write waits for
+    the lock, so it must never be taken while a long export is streaming: the connections
+    of a whole load are opened up front and the threads borrow them.
+
+    Args:
+        conf (object): mysql section of the configuration
+        size (int): number of connections
+
+    Attributes:
+        log_file (str): binlog file of the snapshot
+        log_pos (int): binlog position of the snapshot
+
+    """
+    def __init__(self, conf, size):
+        self.connections = queue.Queue()
+        opened = list()
+        control = mysql_connect(conf)
+        try:
+            with control.cursor() as cursor:
+                cursor.execute("flush tables with read lock")
+                try:
+                    for _ in range(max(1, size)):
+                        connection = mysql_connect(conf, cursorclass=SSCursor)
+                        opened.append(connection)
+                        with connection.cursor() as snapshot:
+                            snapshot.execute("set session transaction isolation level repeatable read")
+                            snapshot.execute("start transaction with consistent snapshot")
+                    self.log_file, self.log_pos = master_status(cursor)
+                finally:
+                    cursor.execute("unlock tables")
+        except Exception as e:
+            for connection in opened:
+                connection.close()
+            raise SysException(e)
+        finally:
+            control.close()
+
+        for connection in opened:
+            self.connections.put(connection)
+        self.size = len(opened)
+
+    @contextmanager
+    def connection(self):
+        """Borrow a snapshot connection, waiting for one to be free"""
+        connection = self.connections.get()
+        try:
+            yield connection
+        finally:
+            self.connections.put(connection)
+
+    def close(self):
+        """End the snapshot transactions and close the connections"""
+        for _ in range(self.size):
+            connection = self.connections.get()
+            try:
+                connection.commit()
+            except Exception as e:
+                logger.warning(f"cannot end snapshot transaction, the reason is {e}")
+            connection.close()
+
+
+def copy_rows(cursor, query, args, db, table, mongo, batch_size, types=None):
+    """Stream the rows of a query into a mongo collection by batches
+
+    Args:
+        cursor (object): PyMySQL cursor, unbuffered to keep memory bounded
+        query (str): select statement
+        args (tuple): query parameters
+        db (str): mongo database name
+        table (str): mongo collection name
+        mongo (object): :class:`.MyMongoDB` instance
+        batch_size (int): number of rows fetched and inserted at once
+        types (dict): column types used to build the conversion plan
+
+    Returns:
+        int: number of documents inserted
+
+    """
+    inserted = 0
+    cursor.execute(query, args)
+    plan = conversion_plan([column[0] for column in cursor.description], types or dict())
+    while True:
+        rows = cursor.fetchmany(batch_size)
+        if not rows:
+            break
+        inserted += mongo.insert_many(convert_rows(rows, plan), db, table)
+    return inserted
+
+
+def stream_load_table(table, conf1, snapshot=False, pool=None):
+    """Load one mysql table into mongo without intermediate files
+
+    Rows are read with an unbuffered server side cursor and inserted in mongo by batches of
+    ``load_batch_size`` rows (option of the mysql section) with unordered ``insert_many``, so
+    memory stays bounded whatever the size of the table.
+
+    Without snapshot the table is loaded only if the binlog did not move during the export.
+    With snapshot the rows are read in a consistent snapshot transaction and the binlog
+    position of the snapshot is recorded, so that the table can be loaded under live
+    traffic and the replicator resumes exactly from the snapshot.
+
+    Args:
+        table (str): mysql table name
+        conf1 (object): whole configuration
+        snapshot (bool): read the table in a consistent snapshot
+        pool (object): :class:`.SnapshotPool` shared by the tables of a load, a snapshot of
+            this table only is taken if None
+
+    Returns:
+        bool: True if the table has been loaded
+
+    """
+    conf = conf1["mysql"]
+    db = conf['databases'].strip()
+    batch_size = conf.getint('load_batch_size', fallback=5000)
+    mongo = MyMongoDB(conf1['mongodb'])
+    types = table_types(table, conf1, mongo)
+    logger.debug(f"begin stream load data from table {table}")
+
+    query = f"select * from `{db}`.`{table}`"
+    if snapshot:
+        own_pool = pool is None
+        if own_pool:
+            pool = SnapshotPool(conf, 1)
+        try:
+            with pool.connection() as connection, connection.cursor() as cursor:
+                mongo.drop_coll(db, table)
+                inserted = copy_rows(cursor, query, None, db, table, mongo, batch_size, types)
+        finally:
+            if own_pool:
+                pool.close()
+        file1, pos1 = file2, pos2 = pool.log_file, pool.log_pos
+    else:
+        connection = mysql_connect(conf, cursorclass=SSCursor)
+        try:
+            with connection.cursor() as cursor:
+                file1, pos1 = master_status(cursor)
+                mongo.drop_coll(db, table)
+                inserted = copy_rows(cursor, query, None, db, table, mongo, batch_size, types)
+                file2, pos2 = master_status(cursor)
+        finally:
+            connection.close()
+
+    logger.debug(f"{table}: {inserted} rows, before {file1}=={pos1}, after {file2}=={pos2}")
+    if file1 == file2 and pos1 == pos2:
+        return write_utils(conf1["mongodb"], table, file1, pos1)
+
+    logger.warning(f"table {table} has not been loaded, binlog moved during the export")
+    return False
+
+
+def snapshot_load_table(table, conf1, pool=None):
+    """:func:`.stream_load_table` in a consistent snapshot"""
+    return stream_load_table(table, conf1, snapshot=True, pool=pool)
+
+
+def integer_primary_key(cursor, db, table):
+    """Single integer primary key column of a table and its bounds
+
+    Returns:
+        tuple: (column, min, max), column is None if the table has no single integer primary key
+
+    """
+    cursor.execute("select column_name, data_type from information_schema.columns "
+                   "where table_schema = %s and table_name = %s and column_key = 'PRI'", (db, table))
+    keys = cursor.fetchall()
+    if len(keys) != 1 or keys[0][1] not in ('tinyint', 'smallint', 'mediumint', 'int', 'bigint'):
+        return None, None, None
+
+    column = keys[0][0]
+    cursor.execute(f"select min(`{column}`), max(`{column}`) from `{db}`.`{table}`")
+    low, high = cursor.fetchall()[0]
+    return column, low, high
+
+
+def chunk_bounds(low, high, chunk_size):
+    """Split a primary key range into chunks
+
+    The first and the last chunk are open ended, so rows inserted outside of
+    ``[low, high]`` after the bounds have been read still belong to a chunk.
+
+    Returns:
+        list: (lo, hi) bounds, lo included, hi excluded, None for no bound
+
+    """
+    if low is None:
+        return [(None, None)]
+    cuts = list(range(low + chunk_size, high + 1, chunk_size))
+    return list(zip([None] + cuts, cuts + [None]))
+
 
+def range_filter(column, lo, hi):
+    """Mongo filter of the documents of a primary key chunk"""
+    cond = dict()
+    if lo is not None:
+        cond['$gte'] = lo
+    if hi is not None:
+        cond['$lt'] = hi
+    if not cond:
+        return {}
+    return {column: cond}
 
-def run_load_data(tables, conf1):
-    sec_list = list()
+
+def load_chunk(table, conf1, column, lo, hi, pool, mongo, types=None):
+    """Load one primary key chunk of a table from a snapshot connection of the pool
+
+    Args:
+        mongo (object): :class:`.MyMongoDB` instance shared by the chunks of the table
+
+    Returns:
+        int: number of documents inserted
+
+    Raises:
+        :class:`.SysException`
+
+    """
     conf = conf1["mysql"]
-    for table in tables:
-        logger.debug(f"begin load data from table {table}")
-        # 步骤1 ： 生成同步前的记录文件
-        temp_file_1 = mysqlinfo_cmd(table, conf)
-
-        # 步骤2： 记录同步前的 file 和 pos
-        file1, pos1 = read_txt(temp_file_1)
-        logger.debug(f"before------->{table}: {file1}=={pos1}")
-
-        # 步骤3： 导出 txt 格式数据
-        txt_file = mysqlcsv_cmd(table, conf)
-        # print(txt_file)
-
-        # 步骤4： 生成同步之后的记录文件
-        temp_file_2 = mysqlinfo_cmd(table, conf)
-
-        # 步骤5： 记录同步后的 file 和 pos
-        file2, pos2 = read_txt(temp_file_2)
-        logger.debug(f"after------->{table}: {file2}=={pos2}")
-        write_utils(conf1["mongodb"], table, file1, pos1)
-
-        # 步骤6：判断是否一致
-        if file1 == file2 and pos1 == pos2:
-            # 步骤7：将 txt 转换为 csv
-            csv_file = txt2csv(txt_file)
-            # print(csv_file)
-
-            # 步骤8: 导入 CVS --> mongodb
-            # 步骤9: 将文件和位置信息写入 util 数据库
-            if import2mongo(csv_file, table, conf1["mongodb"]) and write_utils(conf1["mongodb"], table, file1, pos1):
-                # 步骤10： 导入成功 生成列表
-                sec_list.append(table)
+    db = conf['databases'].strip()
+
+    where, args = list(), list()
+    if lo is not None:
+        where.append(f"`{column}` >= %s")
+        args.append(lo)
+    if hi is not None:
+        where.append(f"`{column}` < %s")
+        args.append(hi)
+    query = f"select * from `{db}`.`{table}`"
+    if where:
+        query += " where " + " and ".join(where)
+
+    with pool.connection() as connection, connection.cursor() as cursor:
+        # 块可能在上次中断时导入了一部分
+        try:
+            mongo.get_coll(table, db).delete_many(range_filter(column, lo, hi))
+        except Exception as e:
+            raise SysException(e)
+        return copy_rows(cursor, query, tuple(args), db, table, mongo,
+                         conf.getint('load_batch_size', fallback=5000), types)
+
+
+def chunked_load_table(table, conf1, pool=None):
+    """Load one mysql table into mongo by primary key chunks, in parallel and resumable
+
+    The table is split into chunks of ``load_chunk_size`` primary key values, loaded by
+    ``load_chunk_workers`` threads from the connections of one :class:`.SnapshotPool`, so
+    every chunk is read from the same snapshot and has the same binlog position. Finished
+    chunks are recorded in the ``load_chunks`` collection of the util database, so a load
+    interrupted by a failure resumes from the unfinished chunks without dropping the
+    collection. The chunks of an earlier run come from an older snapshot: the recorded
+    position is then the oldest one and the changes of the later chunks are replayed, so
+    resuming is refused unless the queue is applied idempotently (``apply_mode``).
+
+    Tables without a single integer primary key are loaded by :func:`.snapshot_load_table`.
+
+    Args:
+        table (str): mysql table name
+        conf1 (object): whole configuration
+        pool (object): :class:`.SnapshotPool` shared by the tables of a load, a snapshot of
+            this table only is taken if None
+
+    Returns:
+        bool: True if the table has been loaded
+
+    """
+    conf = conf1["mysql"]
+    db = conf['databases'].strip()
+    name = f"{db}.{table}"
+    chunk_size = conf.getint('load_chunk_size', fallback=100000)
+    workers = max(1, conf.getint('load_chunk_workers', fallback=4))
+    mongo = MyMongoDB(conf1['mongodb'])
+    chunks = mongo.get_coll('load_chunks', conf1['mongodb']['utildb'])
+
+    job = chunks.find_one({'_id': name})
+    resume = job is not None and job.get('status') == 'running' and job.get('chunk_size') == chunk_size
+    done = {(c['lo'], c['hi']): c for c in chunks.find({'name': name})} if resume else dict()
+    if done and conf1['general'].get('apply_mode', fallback='delete') != 'idempotent':
+        # 之前的块来自更早的快照 重放的插入只有幂等处理时才不会重复
+        raise SysException(f"table {table} has {len(done)} chunks loaded by an earlier run, resuming needs "
+                           f"apply_mode = idempotent, or delete {name} from load_chunks to reload it")
+
+    own_pool = pool is None
+    if own_pool:
+        pool = SnapshotPool(conf, workers)
+    try:
+        return load_chunks(table, conf1, pool, job if resume else None, done)
+    finally:
+        if own_pool:
+            pool.close()
+
+
+def load_chunks(table, conf1, pool, job, done):
+    """Load the chunks of a table not loaded yet, see :func:`.chunked_load_table`
+
+    Args:
+        table (str): mysql table name
+        conf1 (object): whole configuration
+        pool (object): :class:`.SnapshotPool` the chunks are read from
+        job (dict): ``load_chunks`` document of the load to resume, None for a new load
+        done (dict): chunk documents already loaded, by bounds
+
+    Returns:
+        bool: True if the table has been loaded
+
+    """
+    conf = conf1["mysql"]
+    db = conf['databases'].strip()
+    name = f"{db}.{table}"
+    chunk_size = conf.getint('load_chunk_size', fallback=100000)
+    workers = max(1, conf.getint('load_chunk_workers', fallback=4))
+    mongo = MyMongoDB(conf1['mongodb'])
+    chunks = mongo.get_coll('load_chunks', conf1['mongodb']['utildb'])
+
+    if job is not None:
+        column, bounds = job['column'], [tuple(b) for b in job['bounds']]
+        logger.info(f"resume load of table {table}, {len(done)}/{len(bounds)} chunks already loaded")
+    else:
+        # 主键范围在快照中读取
+        with pool.connection() as connection, connection.cursor() as cursor:
+            column, low, high = integer_primary_key(cursor, db, table)
+        if column is None:
+            logger.info(f"table {table} has no integer primary key, load it in one chunk")
+            return snapshot_load_table(table, conf1, pool=pool)
+
+        bounds = chunk_bounds(low, high, chunk_size)
+        done = dict()
+        mongo.drop_coll(db, table)
+        chunks.delete_many({'name': name})
+        chunks.replace_one({'_id': name}, {'status': 'running', 'column': column, 'chunk_size': chunk_size,
+                                           'bounds': bounds}, True)
+
+    def run_chunk(bound):
+        lo, hi = bound
+        rows = load_chunk(table, conf1, column, lo, hi, pool, mongo, types)
+        doc = {'name': name, 'lo': lo, 'hi': hi, 'rows': rows, 'log_file': pool.log_file, 'log_pos': pool.log_pos}
+        chunks.replace_one({'_id': f"{name}:{lo}"}, doc, True)
+        return doc
+
+    types = table_types(table, conf1, mongo)
+    todo = [bound for bound in bounds if bound not in done]
+    failed = 0
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = [executor.submit(run_chunk, bound) for bound in todo]
+        for future in futures:
+            try:
+                doc = future.result()
+                done[(doc['lo'], doc['hi'])] = doc
+            except Exception as e:
+                failed += 1
+                logger.error(f"chunk load of table {table} failed, the reason is {e}")
+
+    if failed:
+        logger.warning(f"table {table}: {failed} chunks not loaded, run --load-data again to resume")
+        return False
+
+    # 同一次导入的块位置相同; 恢复的导入从最早的快照位置开始 之后的变化都会被重放
+    log_file, log_pos = min((doc['log_file'], int(doc['log_pos'])) for doc in done.values())
+    write_utils(conf1["mongodb"], table, log_file, log_pos)
+    chunks.update_one({'_id': name}, {'$set': {'status': 'done'}})
+    chunks.delete_many({'name': name})
+    logger.debug(f"{table}: {sum(doc['rows'] for doc in done.values())} rows in {len(bounds)} chunks")
+    return True
+
+
+def timed_load_table(table, conf1, mode='csv', pool=None):
+    """Load a table with the loader of ``mode`` and measure it
+
+    Args:
+        table (str): mysql table name
+        conf1 (object): whole configuration
+        mode (str): loader to use, one of :data:`LOAD_MODES`
+        pool (object): :class:`.SnapshotPool` of the snapshot loaders
+
+    Returns:
+        tuple: (table, loaded, seconds), loaded is False if the load raised an error
+
+    """
+    start = time.time()
+    try:
+        if pool is not None:
+            loaded = LOAD_MODES[mode](table, conf1, pool=pool)
+        else:
+            loaded = LOAD_MODES[mode](table, conf1)
+    except Exception as e:
+        logger.error(f"load data of table {table} failed, the reason is {e}")
+        loaded = False
+    return table, loaded, time.time() - start
+
+
+def run_load_data(tables, conf1, workers=None, mode=None):
+    """Load the tables from mysql into mongo, several tables at once
+
+    Args:
+        tables (list): mysql table names
+        conf1 (object): whole configuration
+        workers (int): number of tables loaded at the same time, defaults to the
+            ``load_workers`` option of the mysql section, or 1
+        mode (str): loader to use, one of :data:`LOAD_MODES`, defaults to the
+            ``load_mode`` option of the mysql section, or csv
+
+    In snapshot and chunked modes the snapshot connections (``workers``, times
+    ``load_chunk_workers`` in chunked mode) are opened once under a single global read lock
+    and shared by all the tables, which are then loaded from the same snapshot and
+    replicated from the same binlog position.
+
+    Returns:
+        list: loaded tables, in the order of ``tables``
+
+    """
+    if workers is None:
+        workers = conf1["mysql"].getint("load_workers", fallback=1)
+    workers = max(1, workers)
+    if mode is None:
+        mode = conf1["mysql"].get("load_mode", fallback="csv")
+    if mode not in LOAD_MODES:
+        raise SysException(f"unknown load mode {mode}")
+
+    # 所有表共用一次加锁打开的快照 加锁期间不会有导出中的长查询
+    pool = None
+    if mode == 'snapshot':
+        pool = SnapshotPool(conf1["mysql"], min(workers, len(tables)))
+    elif mode == 'chunked':
+        chunk_workers = max(1, conf1["mysql"].getint('load_chunk_workers', fallback=4))
+        pool = SnapshotPool(conf1["mysql"], min(workers, len(tables)) * chunk_workers)
+
+    results = dict()
+    try:
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            for table, loaded, seconds in executor.map(lambda t: timed_load_table(t, conf1, mode, pool), tables):
+                results[table] = loaded
+                logger.info(f"table {table} {'loaded' if loaded else 'NOT loaded'} in {seconds:.1f}s")
+    finally:
+        if pool is not None:
+            pool.close()
+
+    # 步骤 10：按照配置的顺序生成导入成功的列表
+    sec_list = [table for table in tables if results.get(table)]
 
     # 步骤 11：将成功 load_data 的 table 记录在 utils 中
     mongo = MyMongoDB(conf1['mongodb'])
@@ -203,6 +915,18 @@ def run_load_data(tables, conf1):
     return sec_list
 
 
+# csv: mysql 命令导出 txt 按照列的类型转换后导入
+# stream: 直接从 mysql 流式读取 批量写入 mongo 不产生中间文件
+# snapshot: 在一致性快照中流式读取 记录快照的 binlog 位置 导出期间 binlog 变化也可以导入
+# chunked: 按主键范围分块并行导入 记录完成的块 中断后从未完成的块继续
+LOAD_MODES = {
+    'csv': load_table,
+    'stream': stream_load_table,
+    'snapshot': snapshot_load_table,
+    'chunked': chunked_load_table,
+}
+
+
 def mysqlinfo_cmd(table, conf):
     showposcommand = f"mysql -h {conf['host']} -u{conf['user']} -p{conf['password']} -e 'show master status;'"
     # print(showposcommand)
@@ -218,84 +942,83 @@ def mysqlinfo_cmd(table, conf):
 
 
 def run_mysqldump(dump_type, conf, mongodb):
-    for db in conf['databases'].split(','):
-        try:
-            dump_file = mysqldump_cmd(conf, db, dump_type=dump_type)
-            # dump_file = "/home/furuiyang/async/d2.sql"
-        except Exception as e:
-            raise SysException(e)
+    """Import the databases with mysqldump, its output is parsed as it is produced
 
-        if dump_type == 'data':
-            try:
-                mysqldump_parser_data(dump_file, mongodb)
-            except Exception as e:
-                raise SysException(e)
+    Args:
+        dump_type (str): schema, data, or complete for the schema then the data
+        conf (object): mysql section of the configuration
+        mongodb (object): :class:`.MyMongoDB` instance
 
-        if dump_type == 'schema':
-            try:
-                mysqldump_parser_schema(dump_file, mongodb)
-            except Exception as e:
-                raise SysException(e)
+    Raises:
+        :class:`.SysException`
+
+    """
+    for db in conf['databases'].split(','):
+        db = db.strip()
 
-        if dump_type == 'complete':
+        # mysqldump 正常结束之后才记录位置 标记数据库已解析
+        if dump_type in ('schema', 'complete'):
             try:
-                mysqldump_parser_schema(dump_file, mongodb)
+                stream_mysqldump(conf, db, 'schema',
+                                 lambda source: mysqldump_parser_schema(source, mongodb, finish=False),
+                                 lambda databases: finish_schema_import(databases, mongodb))
             except Exception as e:
                 raise SysException(e)
 
+        # 类型信息已经在 schema 中记录 数据按照类型转换
+        if dump_type in ('data', 'complete'):
             try:
-                mysqldump_parser_data(dump_file, mongodb)
+                stream_mysqldump(conf, db, 'data',
+                                 lambda source: import_dump_data(source, conf, mongodb, finish=False),
+                                 lambda result: finish_data_import(*result, mongodb))
             except Exception as e:
                 raise SysException(e)
 
     return True
 
 
-def process_data_buffer(buf, table, db, mongodb):
-    parser = etree.XMLParser(recover=True)
-    tnode = etree.fromstring(buf, parser=parser)
-    doc = dict()
-    for child in tnode:
-        if child.tag == 'field':
-            doc[child.attrib['name']] = child.text
-
-            key = mongodb.get_type_info(table, db)
-            type_info = key.get("types", dict())
+def import_dump_data(dump_file, conf, mongodb, finish=True):
+    """Import the data of a dump, with the pipeline when ``dump_workers`` is set
 
-            if child.text and type_info.get(child.attrib['name']) == "int":
-                doc[child.attrib['name']] = int(child.text)
+    Args:
+        dump_file: dump file name, or binary file object
+        conf (object): mysql section of the configuration
+        mongodb (object): :class:`.MyMongoDB` instance
+        finish (bool): record the position of the dump, see :func:`.finish_data_import`
 
-            elif child.text and type_info.get(child.attrib['name']) == "datetime":
-                _format = "%Y-%m-%d %H:%M:%S"
-                _new = datetime.datetime.strptime(child.text, _format)
-                doc[child.attrib['name']] = _new
+    Returns:
+        tuple: (tables, log_file, log_pos) of the dump
 
-            elif child.text and type_info.get(child.attrib['name']) == "decimal":
-                doc[child.attrib['name']] = float(child.text)
+    """
+    batch_size = conf.getint('dump_batch_size', fallback=1000)
+    workers = conf.getint('dump_workers', fallback=0)
+    if workers > 0:
+        return mysqldump_pipeline_data(dump_file, mongodb, workers, batch_size, finish)
+    return mysqldump_parser_data(dump_file, mongodb, batch_size, finish)
 
-            elif child.text and type_info.get(child.attrib['name']) == "float":
-                doc[child.attrib['name']] = float(child.text)
 
-            # elif child.text and type_info.get(child.attrib['name']) == "longblob":
-            #     pass
+def convert_fields(row, converters):
+    """Convert the text values of a dump row with the converters of its table
 
-            elif child.text and type_info.get(child.attrib['name']) == "time":
-                # "09:00:00" --> datetime.timedelta --> "9:00:00"
-                # "09:00:00" --> "9:00:00"
-                if child.text.startswith("0"):
-                    doc[child.attrib['name']] = child.text[1:]
+    Args:
+        row (dict): text value by column name
+        converters (dict): converter by column name, see :func:`.field_converters`
 
-    try:
-        mongodb.insert(doc, db, table)
-    except Exception as e:
-        raise SysException(e)
+    Returns:
+        dict: the row, with converted values
 
-    del tnode
+    """
+    for name, convert in converters.items():
+        text = row.get(name)
+        if text:
+            try:
+                row[name] = convert(text)
+            except ValueError:
+                pass
+    return row
 
 
-def process_schema_buffer(buf, table, db, mongodb):
-    parser = etree.XMLParser(recover=True)
-    tnode = etree.fromstring(buf, parser=parser)
+def process_schema_node(tnode, table, db, mongodb):
     doc = dict()
     doc['_id'] = db + '.' + table
     doc['primary_key'] = []
@@ -307,118 +1030,503 @@ def process_schema_buffer(buf, table, db, mongodb):
             if child.attrib['Key'] == 'PRI':
                 doc['primary_key'].append(child.attrib['Field'])
 
-            if "int" in child.attrib['Type']:
-                doc["types"].update({child.attrib['Field']: "int"})
-            elif 'datetime' in child.attrib['Type']:
-                doc["types"].update({child.attrib['Field']: "datetime"})
-            elif "decimal" in child.attrib['Type']:
-                doc["types"].update({child.attrib['Field']: "decimal"})
-            elif "longblob" in child.attrib["Type"]:
-                doc["types"].update({child.attrib['Field']: "longblob"})
-            elif "float" in child.attrib["Type"]:
-                doc["types"].update({child.attrib['Field']: "float"})
-            elif "time" in child.attrib["Type"]:
-                doc["types"].update({child.attrib['Field']: "time"})
+            type_name = column_type_name(child.attrib['Type'])
+            if type_name is not None:
+                doc["types"].update({child.attrib['Field']: type_name})
 
     try:
         mongodb.insert_primary_key(doc)
     except Exception as e:
         raise SysException(e)
 
-    del tnode
 
+def flush_rows(docs, db, table, mongodb):
+    """Write a batch of parsed dump rows into their collection
 
-def mysqldump_parser_data(dump_file, mongodb):
-    inputbuffer = ''
-    db_start = re.compile(r'.*<database name.*', re.IGNORECASE)
-    tb_start = re.compile(r'.*<table_data.*', re.IGNORECASE)
-    row_start = re.compile(r'.*<row>.*', re.IGNORECASE)
-    row_end = re.compile(r'.*</row>.*', re.IGNORECASE)
-    master_log = re.compile(r'.*CHANGE MASTER.*', re.IGNORECASE)
-    db = ''
-    table = ''
-    log_file = None
-    log_pos = None
-
-    with open(dump_file, 'r') as inputfile:
-        append = False
-        for line in inputfile:
-            if row_start.match(line):
-                # print('start')
-                inputbuffer = line
-                append = True
-            elif row_end.match(line):
-                # print('end')
-                inputbuffer += line
-                append = False
-                process_data_buffer(inputbuffer, table, db, mongodb)
-                inputbuffer = None
-                del inputbuffer
-            elif append:
-                # print('elif')
-                inputbuffer += line
-            elif db_start.match(line):
-                db = re.findall('name="(.*?)"', line, re.DOTALL)[0]
-                try:
-                    mongodb.drop_db(db)
-                except Exception as e:
-                    raise SysException(e)
-            elif tb_start.match(line):
-                table = re.findall('name="(.*?)"', line, re.DOTALL)[0]
-            elif master_log.match(line):
-                log_file = re.findall("MASTER_LOG_FILE='(.*?)'", line, re.DOTALL)[0]
-                log_pos = re.findall("MASTER_LOG_POS=(.*?);", line, re.DOTALL)[0]
+    Returns:
+        int: number of documents inserted
 
+    """
+    if not docs:
+        return 0
+    try:
+        inserted = mongodb.insert_many(docs, db, table)
+    except Exception as e:
+        raise SysException(e)
+    logger.debug(f"{db}.{table}: {inserted}/{len(docs)} rows inserted")
+    return inserted
+
+
+class MysqldumpReader:
+    """Single pass streaming reader of a ``mysqldump --xml`` output
+
+    The dump is parsed with ``lxml.etree.iterparse``: every row is yielded as soon as its
+    element is complete, then cleared with the elements already read, so memory stays
+    constant whatever the size of the dump.
+
+    Args:
+        source: dump file name, or binary file object like the stdout of mysqldump
+
+    Attributes:
+        tables (dict): tables found so far, by database
+        log_file (str): binlog file of the ``CHANGE MASTER`` comment, if any
+        log_pos (str): binlog position of the ``CHANGE MASTER`` comment, if any
+
+    """
+    master_log = re.compile(r"CHANGE MASTER.*MASTER_LOG_FILE='(.*?)'.*MASTER_LOG_POS=(\d+)", re.IGNORECASE | re.DOTALL)
+
+    def __init__(self, source):
+        self.source = source
+        self.tables = dict()
+        self.log_file = None
+        self.log_pos = None
+
+    def __iter__(self):
+        """Yield the rows of the dump
+
+        Yields:
+            tuple: (db, table, row) where row is the text value, or None, by column name
+
+        """
+        db = None
+        table = None
+        context = etree.iterparse(self.source, events=('start', 'end', 'comment'), huge_tree=True)
+        for event, elem in context:
+            if event == 'comment':
+                match = self.master_log.search(elem.text or '')
+                if match:
+                    self.log_file, self.log_pos = match.group(1), match.group(2)
+            elif event == 'start':
+                if elem.tag == 'database':
+                    if self.log_file is None:
+                        self.read_master_log(elem)
+                    db = elem.get('name')
+                    self.tables[db] = list()
+                elif elem.tag == 'table_data':
+                    table = elem.get('name')
+                    self.tables[db].append(table)
+            elif elem.tag == 'row':
+                yield db, table, {field.get('name'): field.text for field in elem}
+                self.release(elem)
+            elif elem.tag in ('table_data', 'table_structure'):
+                self.release(elem)
+
+    def read_master_log(self, elem):
+        """Look for the ``CHANGE MASTER`` line in the text written before an element
+
+        With ``--master-data=2`` mysqldump writes the line as plain text after the comment of
+        the replication position, so it is the tail of that comment, or the text of the root
+        element, not a comment itself.
+
+        Args:
+            elem (object): element whose start has just been parsed
+
+        """
+        texts = [elem.getparent().text] + [sibling.tail for sibling in elem.itersiblings(preceding=True)]
+        for text in texts:
+            match = self.master_log.search(text or '')
+            if match:
+                self.log_file, self.log_pos = match.group(1), match.group(2)
+                return
+
+    @staticmethod
+    def release(elem):
+        """Free an element and its already parsed siblings"""
+        elem.clear()
+        parent = elem.getparent()
+        while elem.getprevious() is not None:
+            del parent[0]
+
+
+def mysqldump_parser_data(dump_file, mongodb, batch_size=1000, finish=True):
+    """Import the data of a ``mysqldump --xml`` output into mongo
+
+    Rows are buffered per table and written by batches of ``batch_size`` documents with
+    unordered ``insert_many``; rows which cannot be written are logged.
+
+    Args:
+        dump_file: dump file name, or binary file object
+        mongodb (object): :class:`.MyMongoDB` instance
+        batch_size (int): number of rows per insert
+        finish (bool): record the position of the dump, see :func:`.finish_data_import`
+
+    Returns:
+        tuple: (tables, log_file, log_pos) of the dump
+
+    """
+    reader = MysqldumpReader(dump_file)
+    db = None
+    table = None
+    converters = dict()
+    docs = list()
+
+    for row_db, row_table, row in reader:
+        if row_db != db or row_table != table:
+            flush_rows(docs, db, table, mongodb)
+            docs = list()
+        if row_db != db:
+            db = row_db
+            table = None
+            try:
+                mongodb.drop_db(db)
+            except Exception as e:
+                raise SysException(e)
+        if row_table != table:
+            table = row_table
+            # 每张表的转换函数只生成一次
+            converters = field_converters(dump_table_types(table, db, mongodb))
+
+        docs.append(convert_fields(row, converters))
+        if len(docs) >= batch_size:
+            flush_rows(docs, db, table, mongodb)
+            docs = list()
+
+    flush_rows(docs, db, table, mongodb)
+
+    result = (reader.tables, reader.log_file, reader.log_pos)
+    if finish:
+        finish_data_import(*result, mongodb)
+    return result
+
+
+def finish_data_import(tables, log_file, log_pos, mongodb):
+    """Record the replication position of a dump and mark its databases as parsed
+
+    The ``CHANGE MASTER`` coordinates of the dump are written in mysqllog for every table of
+    the dumped databases, the replicator resumes each of them from there.
+
+    Args:
+        tables (dict): dumped tables by database
+        log_file (str): binlog file of the dump
+        log_pos (str): binlog position of the dump
+        mongodb (object): :class:`.MyMongoDB` instance
+
+    """
     if log_file is not None and log_pos is not None:
+        positions = {f"{db}.{table}": (log_file, int(log_pos)) for db in tables for table in tables[db]}
         try:
-            mongodb.write_log_pos(log_file, log_pos)
+            mongodb.write_log_pos_many(positions)
         except Exception as e:
             raise SysException(e)
+    else:
+        logger.warning('No CHANGE MASTER position in the dump of ' + ', '.join(tables))
 
-    try:
-        mongodb.make_db_as_parsed(db, 'data')
-    except Exception as e:
-        logger.error('Cannot insert db ' + db + ' as parsed')
+    for db in tables:
+        try:
+            mongodb.make_db_as_parsed(db, 'data')
+        except Exception as e:
+            logger.error('Cannot insert db ' + db + ' as parsed')
+
+
+class DumpRowSplitter:
+    """Reader stage of the pipelined dump import
+
+    Cuts a ``mysqldump --xml`` output into chunks of raw ``<row>`` elements without parsing
+    them, relying on the layout written by mysqldump: one tag per line.
+
+    Args:
+        source: dump file name, or binary file object
+        chunk_size (int): number of rows per chunk
+
+    Attributes:
+        tables (dict): tables found so far, by database
+        log_file (str): binlog file of the ``CHANGE MASTER`` comment, if any
+        log_pos (str): binlog position of the ``CHANGE MASTER`` comment, if any
+
+    """
+    name_attr = re.compile(rb'name="(.*?)"')
+
+    def __init__(self, source, chunk_size):
+        self.source = source
+        self.chunk_size = chunk_size
+        self.tables = dict()
+        self.log_file = None
+        self.log_pos = None
+
+    def __iter__(self):
+        """Yield the rows of the dump by chunks
+
+        Yields:
+            tuple: (db, table, rows) where rows is a list of ``<row>`` elements as bytes
+
+        """
+        if isinstance(self.source, str):
+            with open(self.source, 'rb') as f:
+                yield from self.split(f)
+        else:
+            yield from self.split(self.source)
+
+    def split(self, lines):
+        db = None
+        table = None
+        rows = list()
+        row = None
+        for line in lines:
+            if row is not None:
+                row.append(line)
+                if b'</row>' in line:
+                    rows.append(b''.join(row))
+                    row = None
+                    if len(rows) >= self.chunk_size:
+                        yield db, table, rows
+                        rows = list()
+            elif b'<row>' in line:
+                if b'</row>' in line:
+                    rows.append(line)
+                    if len(rows) >= self.chunk_size:
+                        yield db, table, rows
+                        rows = list()
+                else:
+                    row = [line]
+            elif b'<table_data' in line or b'<database' in line:
+                if rows:
+                    yield db, table, rows
+                    rows = list()
+                name = self.name_attr.search(line).group(1).decode()
+                if b'<database' in line:
+                    db = name
+                    self.tables[db] = list()
+                else:
+                    table = name
+                    self.tables[db].append(table)
+            elif b'CHANGE MASTER' in line:
+                match = MysqldumpReader.master_log.search(line.decode())
+                if match:
+                    self.log_file, self.log_pos = match.group(1), match.group(2)
+        if rows:
+            yield db, table, rows
+
+
+DUMP_ROWS_ROOT = b'<rows xmlns:xsi="http://www.w3.org/2001/XMLSchema-instance">'
+
+
+def parse_dump_rows(rows, types):
+    """Parse a chunk of raw ``<row>`` elements into typed documents
+
+    Args:
+        rows (list): ``<row>`` elements as bytes
+        types (dict): type of each column, as in the ``types`` map of ``primary_keys``
+
+    Returns:
+        list: documents
+
+    """
+    parser = etree.XMLParser(recover=True, huge_tree=True)
+    root = etree.fromstring(DUMP_ROWS_ROOT + b''.join(rows) + b'</rows>', parser=parser)
+    converters = field_converters(types)
+    return [convert_fields({field.get('name'): field.text for field in row}, converters) for row in root]
+
+
+def dump_parser_worker(tasks, results):
+    """Parser stage of the pipelined dump import: raw rows --> typed documents
+
+    Exits with code 1 when a chunk could not be parsed.
+    """
+    failed = 0
+    while True:
+        task = tasks.get()
+        if task is None:
+            results.put(None)
+            break
+        db, table, types, rows = task
+        try:
+            docs = parse_dump_rows(rows, types)
+        except Exception as e:
+            failed += 1
+            logger.error(f"Cannot parse {len(rows)} rows of {db}.{table}. Error: {e}")
+            continue
+        results.put((db, table, docs))
+    if failed:
+        sys.exit(1)
+
+
+def dump_writer_worker(mongo_conf, results, parsers):
+    """Writer stage of the pipelined dump import: bulk inserts of the parsed documents
+
+    Exits with code 1 when a batch could not be inserted.
+    """
+    mongodb = MyMongoDB(mongo_conf)
+    inserted = 0
+    failed = 0
+    while parsers:
+        result = results.get()
+        if result is None:
+            parsers -= 1
+            continue
+        db, table, docs = result
+        try:
+            inserted += flush_rows(docs, db, table, mongodb)
+        except Exception as e:
+            failed += 1
+            logger.error(f"Cannot insert {len(docs)} rows into {db}.{table}. Error: {e}")
+    logger.info(f"Dump import writer inserted {inserted} rows")
+    if failed:
+        sys.exit(1)
 
 
-def mysqldump_parser_schema(dump_file, mongodb):
-    inputbuffer = ''
-    db_start = re.compile(r'.*<database name.*', re.IGNORECASE)
-    tb_start = re.compile(r'.*<table_structure.*', re.IGNORECASE)
-    tb_end = re.compile(r'.*</table_structure.*', re.IGNORECASE)
-    db = ''
-    table = ''
-
-    with open(dump_file, 'r') as inputfile:
-        append = False
-        for line in inputfile:
-            if tb_start.match(line):
-                # print('start')
-                inputbuffer = line
-                append = True
-                table = re.findall('name="(.*?)"', line, re.DOTALL)[0]
-            elif tb_end.match(line):
-                # print('end')
-                inputbuffer += line
-                append = False
-                process_schema_buffer(inputbuffer, table, db, mongodb)
-                inputbuffer = None
-                del inputbuffer
-            elif append:
-                # print('elif')
-                inputbuffer += line
-            elif db_start.match(line):
-                db = re.findall('name="(.*?)"', line, re.DOTALL)[0]
+def check_processes(procs):
+    """Raise if a process of a pipeline has failed
+
+    Raises:
+        :class:`.SysException`
+
+    """
+    for proc in procs:
+        if proc.exitcode not in (None, 0):
+            raise SysException(f"{proc.name} process exited with code {proc.exitcode}")
 
+
+def put_checked(queue_out, item, procs, timeout=1):
+    """Put an item on a pipeline queue, failing instead of blocking when a stage has died
+
+    Raises:
+        :class:`.SysException`
+
+    """
+    while True:
+        try:
+            queue_out.put(item, timeout=timeout)
+            return
+        except queue.Full:
+            check_processes(procs)
+
+
+def join_processes(procs, timeout=1):
+    """Wait for the end of the processes of a pipeline, failing as soon as one fails
+
+    Raises:
+        :class:`.SysException`
+
+    """
+    while any(proc.is_alive() for proc in procs):
+        for proc in procs:
+            proc.join(timeout)
+            check_processes(procs)
+    check_processes(procs)
+
+
+def mysqldump_pipeline_data(dump_file, mongodb, workers, batch_size=1000, finish=True):
+    """Import the data of a ``mysqldump --xml`` output into mongo with a pipeline of processes
+
+    A reader stage cuts the dump into chunks of ``batch_size`` raw rows, ``workers`` parser
+    processes turn them into typed documents and a writer process inserts them by batches.
+    The stages are connected by bounded queues, so memory stays flat while all the cores
+    are used.
+    The processes are watched while the dump is read: when one of them fails the others
+    are terminated and an error is raised, before the position of the dump is recorded.
+
+    Args:
+        dump_file: dump file name, or binary file object
+        mongodb (object): :class:`.MyMongoDB` instance
+        workers (int): number of parser processes
+        batch_size (int): number of rows per chunk and per insert
+        finish (bool): record the position of the dump, see :func:`.finish_data_import`
+
+    Returns:
+        tuple: (tables, log_file, log_pos) of the dump
+
+    Raises:
+        :class:`.SysException`
+
+    """
+    tasks = Queue(maxsize=2 * workers)
+    results = Queue(maxsize=2 * workers)
+    parsers = [Process(name='dump_parser', target=dump_parser_worker, args=(tasks, results))
+               for _ in range(workers)]
+    writer = Process(name='dump_writer', target=dump_writer_worker, args=(mongodb.conf, results, workers))
+    for proc in parsers + [writer]:
+        proc.daemon = True
+        proc.start()
+
+    procs = parsers + [writer]
+    splitter = DumpRowSplitter(dump_file, batch_size)
+    db = None
+    table = None
+    types = dict()
     try:
-        mongodb.make_db_as_parsed(db, 'schema')
-    except Exception as e:
-        logger.error('Cannot insert db ' + db + ' as parsed')
+        for chunk_db, chunk_table, rows in splitter:
+            if chunk_db != db:
+                db = chunk_db
+                table = None
+                try:
+                    mongodb.drop_db(db)
+                except Exception as e:
+                    raise SysException(e)
+            if chunk_table != table:
+                table = chunk_table
+                # 每张表只读取一次类型信息 随数据块发送给解析进程
+                types = dump_table_types(table, db, mongodb)
+            put_checked(tasks, (db, table, types, rows), procs)
+        for _ in parsers:
+            put_checked(tasks, None, procs)
+        join_processes(procs)
+    except BaseException:
+        # 任何一个阶段失败 其他进程可能永远阻塞在队列上
+        for proc in procs:
+            if proc.is_alive():
+                proc.terminate()
+        raise
+
+    result = (splitter.tables, splitter.log_file, splitter.log_pos)
+    if finish:
+        finish_data_import(*result, mongodb)
+    return result
+
+
+def mysqldump_parser_schema(dump_file, mongodb, finish=True):
+    """Record the primary keys and column types of the tables of a ``mysqldump --xml`` output
+
+    Args:
+        dump_file: dump file name, or binary file object like the stdout of mysqldump
+        mongodb (object): :class:`.MyMongoDB` instance
+        finish (bool): mark the databases as parsed, see :func:`.finish_schema_import`
+
+    Returns:
+        list: databases of the dump
+
+    """
+    databases = list()
+    db = ''
+
+    for event, elem in etree.iterparse(dump_file, events=('start', 'end'), huge_tree=True):
+        if event == 'start':
+            if elem.tag == 'database':
+                db = elem.get('name')
+                databases.append(db)
+        elif elem.tag == 'table_structure':
+            process_schema_node(elem, elem.get('name'), db, mongodb)
+            MysqldumpReader.release(elem)
+
+    if finish:
+        finish_schema_import(databases, mongodb)
+    return databases
+
+
+def finish_schema_import(databases, mongodb):
+    """Mark the databases of a schema dump as parsed"""
+    for db in databases:
+        try:
+            mongodb.make_db_as_parsed(db, 'schema')
+        except Exception as e:
+            logger.error('Cannot insert db ' + db + ' as parsed')
     # TODO add index from mysql schema
 
 
 def mysqldump_cmd(conf, db, dump_type):
-    dump_file = NamedTemporaryFile(delete=False)
+    """Start mysqldump on a database, its XML output is read from the process stdout
+
+    Args:
+        conf (object): mysql section of the configuration
+        db (str): mysql database name
+        dump_type (str): schema or data
+
+    Returns:
+        object: the mysqldump process
+
+    Raises:
+        :class:`.SysException`
+
+    """
     dumpcommand = ['mysqldump',
                     '--user=' + conf['user'],
                     '--host=' + conf['host'],
@@ -431,8 +1539,6 @@ def mysqldump_cmd(conf, db, dump_type):
                     '--master-data=2',
                     "--default-character-set=utf8",
                    ]
-    if conf['password'] != '':
-        dumpcommand.append('--password=' + conf['password'])
     if dump_type == 'schema':
         dumpcommand.append('--no-data')
     elif dump_type == 'data':
@@ -441,17 +1547,47 @@ def mysqldump_cmd(conf, db, dump_type):
     dumpcommand.append(db)
 
     logger.debug('executing: {0}'.format(' '.join(dumpcommand)))
+    if conf['password'] != '':
+        dumpcommand.append('--password=' + conf['password'])
 
-    with open(dump_file.name, 'wb', 0) as f:
-        try:
-            p1 = subprocess.Popen(dumpcommand, stdout=f)
-        except Exception as e:
-            raise SysException(e)
-    p1.wait()
+    try:
+        return subprocess.Popen(dumpcommand, stdout=subprocess.PIPE, bufsize=1024 * 1024)
+    except Exception as e:
+        raise SysException(e)
+
+
+def stream_mysqldump(conf, db, dump_type, parse, finish=None):
+    """Run mysqldump on a database and parse its output while it is produced
+
+    mysqldump runs with ``--force``, so its output can be complete XML even when it failed:
+    ``finish`` is called only once it has exited successfully.
+
+    Args:
+        conf (object): mysql section of the configuration
+        db (str): mysql database name
+        dump_type (str): schema or data
+        parse (callable): parser called with the binary stdout of mysqldump
+        finish (callable): called with the result of ``parse`` when mysqldump succeeded
+
+    Raises:
+        :class:`.SysException`
+
+    """
+    proc = mysqldump_cmd(conf, db, dump_type)
+    try:
+        result = parse(proc.stdout)
+    except Exception:
+        proc.kill()
+        raise
+    finally:
+        proc.stdout.close()
+        proc.wait()
 
-    return dump_file.name
+    if proc.returncode != 0:
+        raise SysException(f"mysqldump of {db} ended with code {proc.returncode}")
 
-    # TODO save log_pos to mongo to start from here with replicator
+    if finish is not None:
+        finish(result)
 
 
 class LoggerWriter:
@@ -30,41 +30,37 @@ if __name__ == '__main__':
     args = parser.parse_args()
     mongo = MyMongoDB(config['mongodb'])
     if args.mysqldump_data:
-        # 将 mysqldump_data 路径屏蔽
-        sys.exit(0)
-        # try:
-        #     utils.run_mysqldump(dump_type='data', conf=config['mysql'], mongodb=mongo)
-        #     logger.info('Data dump procedure ended')
-        #     sys.exit(0)
-        # except Exception as e:
-        #     logger.error('Data dump procedure ended with errors: ' + str(e))
-        #     sys.exit(1)
+        try:
+            utils.run_mysqldump(dump_type='data', conf=config['mysql'], mongodb=mongo)
+            logger.info('Data dump procedure ended')
+            sys.exit(0)
+        except Exception as e:
+            logger.error('Data dump procedure ended with errors: ' + str(e))
+            sys.exit(1)
     elif args.mysqldump_schema:
-        # 屏蔽 mysqldump_schema
-        sys.exit(0)
-        # try:
-        #     utils.run_mysqldump(dump_type='schema', conf=config['mysql'], mongodb=mongo)
-        #     logger.info('Schema dump procedure ended')
-        #     sys.exit(0)
-        # except Exception as e:
-        #     logger.error('Schema dump procedure ended with errors: ' + str(e))
-        #     sys.exit(1)
+        try:
+            utils.run_mysqldump(dump_type='schema', conf=config['mysql'], mongodb=mongo)
+            logger.info('Schema dump procedure ended')
+            sys.exit(0)
+        except Exception as e:
+            logger.error('Schema dump procedure ended with errors: ' + str(e))
+            sys.exit(1)
     elif args.mysqldump_complete:
-        sys.exit(0)
-        # try:
-        #     utils.run_mysqldump(dump_type='complete', conf=config['mysql'], mongodb=mongo)
-        #     logger.info('Complete dump procedure ended')
-        #     sys.exit(0)
-        # except Exception as e:
-        #     logger.error('Complete dump procedure ended with errors: ' + str(e))
-        #     sys.exit(1)
+        try:
+            utils.run_mysqldump(dump_type='complete', conf=config['mysql'], mongodb=mongo)
+            logger.info('Complete dump procedure ended')
+            sys.exit(0)
+        except Exception as e:
+            logger.error('Complete dump procedure ended with errors: ' + str(e))
+            sys.exit(1)
     if args.load_data:
         try:
             tables = eval(config['mysql']['table'])
             # print(tables)
             # print(type(tables))
             start = time.time()
-            sec_list = utils.run_load_data(tables, conf1=config)
+            sec_list = utils.run_load_data(tables, conf1=config, workers=args.load_workers,
+                                           mode=args.load_mode)
             # sec_list = []
             end = time.time()
             logger.info(f"The seccess table list is {sec_list}")
@@ -0,0 +1,56 @@
+import time
+
+from mymongolib.checkpoint import Checkpointer
+from mymongolib.mysql import binlog_seqnum
+
+
+class FakeMongo:
+    def __init__(self):
+        self.flushes = list()
+
+    def write_log_pos_many(self, positions):
+        self.flushes.append(positions)
+
+
+def test_flush_after_max_events():
+    mongo = FakeMongo()
+    checkpointer = Checkpointer(mongo, interval=60000, max_events=3)
+
+    checkpointer.update(['db.a'], 'bin.000001', 100)
+    checkpointer.update(['db.a', 'db.b'], 'bin.000001', 200)
+    assert mongo.flushes == []
+
+    checkpointer.update(['db.b'], 'bin.000001', 300)
+    assert mongo.flushes == [{'db.a': ('bin.000001', 200), 'db.b': ('bin.000001', 300)}]
+
+    # only the positions changed since the last flush are written
+    checkpointer.update(['db.a'], 'bin.000001', 400)
+    checkpointer.flush()
+    assert mongo.flushes[1:] == [{'db.a': ('bin.000001', 400)}]
+
+
+def test_flush_after_interval():
+    mongo = FakeMongo()
+    checkpointer = Checkpointer(mongo, interval=50, max_events=1000)
+
+    checkpointer.update(['db.a'], 'bin.000001', 100)
+    checkpointer.tick()
+    assert mongo.flushes == []
+
+    time.sleep(0.06)
+    # binlog idle: the heartbeat flushes the pending position
+    checkpointer.tick()
+    assert mongo.flushes == [{'db.a': ('bin.000001', 100)}]
+
+    time.sleep(0.06)
+    checkpointer.tick()
+    assert len(mongo.flushes) == 1
+
+
+def test_binlog_seqnum_orders_events():
+    first = binlog_seqnum(400, 100, 'bin.000025')
+    assert first == (25 << 32) + 300
+    # rows of an event stay below the start of the next one
+    assert first + 99 < binlog_seqnum(500, 100, 'bin.000025')
+    # a new binlog file starts after every position of the previous one
+    assert binlog_seqnum(500, 100, 'bin.000025') < binlog_seqnum(120, 100, 'bin.000026')
@@ -0,0 +1,121 @@
+from pymongo import DeleteOne, InsertOne, ReplaceOne, UpdateOne
+
+from mymongolib.datamunging import DataMunging
+
+
+class FakeMongo:
+    """In-memory stand-in for MyMongoDB, recording what the apply writes"""
+    queue_layout = 'work'
+
+    def __init__(self, applied=None, offset=-1, keys=None):
+        self.applied = applied or dict()   # table --> operations applied by bulk_write
+        self.offset = offset
+        self.keys = keys or dict()
+        self.queue_hwm = -1
+        self.writes = list()
+        self.deleted = list()
+        self.offsets = list()
+
+    def set_queue_shard(self, index, count):
+        pass
+
+    def read_queue_offset(self):
+        return self.offset
+
+    def write_queue_offset(self, seqnum):
+        self.offsets.append(seqnum)
+
+    def seek_queue(self, seqnum):
+        self.queue_hwm = seqnum
+
+    def purge_queue(self, seqnum):
+        return 0
+
+    def get_primary_key(self, table, db):
+        key = self.keys.get(table)
+        return None if key is None else {'_id': db + '.' + table, 'primary_key': key}
+
+    def ensure_index(self, key, schema, table):
+        pass
+
+    def bulk_write(self, requests, schema, collection):
+        self.writes.append((collection, requests))
+        return min(len(requests), self.applied.get(collection, len(requests)))
+
+    def delete_many_from_queue(self, ids):
+        self.deleted.extend(ids)
+
+
+def record(seqnum, table, event_type='insert', values=None):
+    return {'_id': seqnum, 'seqnum': seqnum, 'schema': 'datacenter', 'table': table,
+            'event_type': event_type, 'values': values or {'id': seqnum}}
+
+
+def test_apply_batch_groups_records_by_table():
+    mongo = FakeMongo()
+    munging = DataMunging(mongo, None)
+    records = [record(1, 'a'), record(2, 'b'), record(3, 'a')]
+
+    assert munging.apply_batch(records) == 3
+    assert [(table, len(requests)) for table, requests in mongo.writes] == [('a', 2), ('b', 1)]
+    assert sorted(mongo.deleted) == [1, 2, 3]
+    assert mongo.offsets == [3]
+    assert mongo.queue_hwm == 3
+
+
+def test_apply_batch_rewinds_to_first_failure():
+    # a applies its first record only, b applies everything
+    mongo = FakeMongo(applied={'a': 1})
+    munging = DataMunging(mongo, None)
+    records = [record(1, 'a'), record(2, 'b'), record(3, 'a'), record(4, 'b'), record(5, 'a')]
+
+    assert munging.apply_batch(records) == 3
+    assert sorted(mongo.deleted) == [1, 2, 4]
+    # everything below the first failure is applied, the queue is read again from there
+    assert mongo.offsets == [2]
+    assert mongo.queue_hwm == 2
+
+
+def test_apply_batch_idempotent_keeps_queue_entries():
+    mongo = FakeMongo(applied={'a': 0}, offset=10)
+    munging = DataMunging(mongo, None, idempotent=True)
+    records = [record(11, 'b'), record(12, 'a'), record(13, 'b')]
+
+    assert munging.apply_batch(records) == 2
+    assert mongo.deleted == []
+    assert mongo.offsets == [11]
+    assert mongo.queue_hwm == 11
+
+
+def test_make_operation_upserts_by_primary_key():
+    munging = DataMunging(FakeMongo(), None)
+    row = {'id': 1, 'name': 'first'}
+    update = {'before': row, 'after': {'id': 1, 'name': 'second'}}
+
+    insert = munging.make_operation(record(1, 'a', 'insert', row), ['id'], upsert=True)
+    assert insert == ReplaceOne({'id': 1}, row, upsert=True)
+    assert munging.make_operation(record(2, 'a', 'update', update), ['id'], upsert=True) == \
+        UpdateOne({'id': 1}, {'$set': update['after']}, upsert=True)
+    assert munging.make_operation(record(3, 'a', 'delete', row), ['id'], upsert=True) == DeleteOne({'id': 1})
+
+
+def test_make_operation_without_key_never_upserts():
+    munging = DataMunging(FakeMongo(), None)
+    row = {'id': 1, 'name': 'first'}
+    update = {'before': row, 'after': {'id': 1, 'name': 'second'}}
+
+    assert munging.make_operation(record(1, 'a', 'insert', row), None, upsert=True) == InsertOne(row)
+    assert munging.make_operation(record(2, 'a', 'update', update), None, upsert=True) == \
+        ReplaceOne(row, update['after'])
+    assert munging.make_operation(record(3, 'a', 'delete', row), None, upsert=True) == DeleteOne(row)
+    # a key column missing from the row is the same as no key
+    assert munging.make_operation(record(4, 'a', 'insert', row), ['uid'], upsert=True) == InsertOne(row)
+    assert munging.make_operation(record(5, 'a', 'truncate', row)) is None
+
+
+def test_key_filter():
+    row = {'id': 1, 'code': 'x', 'name': 'first'}
+
+    assert DataMunging.key_filter(row, ['id', 'code']) == {'id': 1, 'code': 'x'}
+    assert DataMunging.key_filter(row, None) == row
+    assert DataMunging.key_filter(row, ['uid']) == row
@@ -0,0 +1,48 @@
+import datetime
+
+from mymongolib.utils import chunk_bounds, conversion_plan, convert_rows, read_mysql_txt
+
+# mysql -e "select * from comcn_bankaccount", tab separated with a header line
+MYSQL_TXT = ('id\tname\tbalance\tupdated\topened\n'
+             '1\tfirst\\taccount\t10.50\t2019-08-01 09:30:00\t2019-08-01\n'
+             '2\tNULL\tNULL\t2019-08-02 10:00:00\tNULL\n'
+             '3\tline\\nbreak\tn/a\t2019-08-03 11:00:00\t2019-08-03\n')
+
+TYPES = {'id': 'int', 'balance': 'decimal', 'updated': 'datetime', 'opened': 'datetime'}
+
+
+def test_chunk_bounds():
+    assert chunk_bounds(None, None, 10) == [(None, None)]
+    assert chunk_bounds(1, 5, 10) == [(None, None)]
+    assert chunk_bounds(1, 25, 10) == [(None, 11), (11, 21), (21, None)]
+    assert chunk_bounds(1, 21, 10) == [(None, 11), (11, 21), (21, None)]
+
+
+def test_read_mysql_txt_by_batches(tmp_path):
+    file = tmp_path / 'comcn_bankaccount.txt'
+    file.write_text(MYSQL_TXT)
+
+    batches = list(read_mysql_txt(str(file), 2))
+
+    assert [len(rows) for columns, rows in batches] == [2, 1]
+    assert batches[0][0] == ['id', 'name', 'balance', 'updated', 'opened']
+    assert batches[0][1][0][1] == 'first\taccount'
+    assert batches[0][1][1][1:3] == [None, None]
+    assert batches[1][1][0][1] == 'line\nbreak'
+
+
+def test_convert_rows(tmp_path):
+    file = tmp_path / 'comcn_bankaccount.txt'
+    file.write_text(MYSQL_TXT)
+
+    docs = list()
+    for columns, rows in read_mysql_txt(str(file), 1000):
+        docs.extend(convert_rows(rows, conversion_plan(columns, TYPES)))
+
+    assert docs[0] == {'id': 1, 'name': 'first\taccount', 'balance': 10.5,
+                       'updated': datetime.datetime(2019, 8, 1, 9, 30),
+                       'opened': datetime.datetime(2019, 8, 1)}
+    assert docs[1]['name'] is None and docs[1]['balance'] is None and docs[1]['opened'] is None
+    # a value which cannot be converted is kept as text, the rest of the row is converted
+    assert docs[2]['balance'] == 'n/a'
+    assert docs[2]['id'] == 3
@@ -0,0 +1,56 @@
+import io
+
+from mymongolib.utils import DumpRowSplitter, MysqldumpReader
+
+# mysqldump --xml --master-data=2 --single-transaction datacenter
+# the CHANGE MASTER line is written as plain text after the position comment
+MASTER_DATA_DUMP = b'''<?xml version="1.0"?>
+<mysqldump xmlns:xsi="http://www.w3.org/2001/XMLSchema-instance">
+<!--
+-
+- Position to start replication or point-in-time recovery from
+-
+-->
+
+-- CHANGE MASTER TO MASTER_LOG_FILE='bin.000025', MASTER_LOG_POS=329099774;
+<database name="datacenter">
+	<table_data name="comcn_bankaccount">
+	<row>
+		<field name="id">1</field>
+		<field name="name">first account</field>
+		<field name="updated">2019-08-01 09:30:00</field>
+	</row>
+	<row>
+		<field name="id">2</field>
+		<field name="name" xsi:nil="true" />
+		<field name="updated">2019-08-02 10:00:00</field>
+	</row>
+	</table_data>
+	<table_data name="comcn_empty">
+	</table_data>
+</database>
+</mysqldump>
+'''
+
+
+def test_reader_finds_master_position():
+    reader = MysqldumpReader(io.BytesIO(MASTER_DATA_DUMP))
+    rows = list(reader)
+
+    assert (reader.log_file, reader.log_pos) == ('bin.000025', '329099774')
+    assert reader.tables == {'datacenter': ['comcn_bankaccount', 'comcn_empty']}
+    assert rows == [
+        ('datacenter', 'comcn_bankaccount', {'id': '1', 'name': 'first account', 'updated': '2019-08-01 09:30:00'}),
+        ('datacenter', 'comcn_bankaccount', {'id': '2', 'name': None, 'updated': '2019-08-02 10:00:00'}),
+    ]
+
+
+def test_readers_agree_on_master_position():
+    reader = MysqldumpReader(io.BytesIO(MASTER_DATA_DUMP))
+    list(reader)
+    splitter = DumpRowSplitter(io.BytesIO(MASTER_DATA_DUMP), 1000)
+    chunks = list(splitter)
+
+    assert (splitter.log_file, splitter.log_pos) == (reader.log_file, reader.log_pos)
+    assert splitter.tables == reader.tables
+    assert [(db, table, len(rows)) for db, table, rows in chunks] == [('datacenter', 'comcn_bankaccount', 2)]